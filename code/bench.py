@@ -0,0 +1,146 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# End-to-end load benchmark: replays synthetic weekly playlists through main.main()
+# against the local stand-in servers of fakes.py.
+#
+#   python bench.py                       # 50 / 500 / 5000 tracks
+#   python bench.py --tracks 500 --weeks 2 --latency 0.02 --error-rate 0.01
+#
+# Each size runs in its own process so peak memory (max RSS) is measured per scenario.
+
+def run_scenario(args, result_path):
+    import fakes
+
+    size = args.tracks[-1]
+
+    workdir = tempfile.mkdtemp(prefix="octo-bench-")
+    music = os.path.join(workdir, "music")
+    os.makedirs(music)
+    os.chdir(workdir)
+
+    world = fakes.World(library_size=args.library, seed=args.seed)
+    world.download_dir = music
+    subsonic_srv = fakes.FakeSubsonic(world, latency=args.latency, error_rate=args.error_rate,
+                                      download_delay=args.download_delay, scan_duration=args.scan_duration,
+                                      slow_rate=args.slow_rate).start()
+    lb_srv = fakes.FakeListenBrainz(world, latency=args.latency).start()
+    youtube_fake = fakes.FakeYoutube(world, latency=args.latency)
+    youtube_fake.install()
+
+    # main.py reads its configuration at import time
+    os.environ.update({
+        'LB_BASE_URL': lb_srv.url,
+        'LB_USER': 'bench',
+        'SUBSONIC_URL': subsonic_srv.url,
+        'SUBSONIC_USER': 'bench',
+        'SUBSONIC_PASS': 'bench',
+        'LOCAL_DOWNLOAD_PATH': music,
+        'STATE_DB': os.path.join(workdir, 'state.db'),
+        'SUBSONIC_RATE': str(args.rate),
+        'TRIGGER_RATE': str(args.rate),
+        'LB_RATE': str(args.rate),
+        'YOUTUBE_RATE': str(args.rate),
+        'DOWNLOAD_SETTLE': '0',
+        'DOWNLOAD_WAIT_TIMEOUT': '30',
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    import logs
+    logs.setup(main.LOG_LEVEL, main.LOG_JSON)
+
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+
+    results = []
+    for week in range(args.weeks):
+        world.new_week(size, carry_over=args.carry_over)
+        before_sub = dict(subsonic_srv.requests)
+        before_lb = dict(lb_srv.requests)
+        before_yt = dict(youtube_fake.requests)
+        log_path = os.path.join(workdir, f"week{week + 1}.log")
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        with open(log_path, 'w', encoding='utf-8') as log, contextlib.redirect_stdout(log):
+            main.main()
+        wall = time.perf_counter() - start
+        diff = lambda now, before: {k: v - before.get(k, 0) for k, v in now.items() if v - before.get(k, 0)}
+        week_result = {
+            'tracks': size,
+            'week': week + 1,
+            'wall_s': round(wall, 3),
+            'cpu_s': round(time.process_time() - start_cpu, 3),
+            'subsonic_requests': diff(subsonic_srv.requests, before_sub),
+            'listenbrainz_requests': diff(lb_srv.requests, before_lb),
+            'youtube_requests': diff(youtube_fake.requests, before_yt),
+            'log': log_path,
+        }
+        if args.tracemalloc:
+            week_result['py_peak_mib'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+            tracemalloc.reset_peak()
+        results.append(week_result)
+
+    for r in results:
+        r['max_rss_mib'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    subsonic_srv.stop()
+    lb_srv.stop()
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f)
+
+def print_report(results):
+    print(f"{'tracks':>7} {'week':>4} {'wall s':>8} {'cpu s':>7} {'subsonic':>9} {'lb':>4} {'yt':>4} {'rss MiB':>8}  detail")
+    for r in results:
+        sub = sum(r['subsonic_requests'].values())
+        detail = ", ".join(f"{k}={v}" for k, v in sorted(r['subsonic_requests'].items()))
+        print(f"{r['tracks']:>7} {r['week']:>4} {r['wall_s']:>8.2f} {r['cpu_s']:>7.2f} {sub:>9} "
+              f"{sum(r['listenbrainz_requests'].values()):>4} {sum(r['youtube_requests'].values()):>4} "
+              f"{r['max_rss_mib']:>8.1f}  {detail}")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of main.main() against local fake servers.")
+    parser.add_argument('--tracks', type=int, nargs='+', default=[50, 500, 5000], help="playlist sizes to replay")
+    parser.add_argument('--weeks', type=int, default=1, help="consecutive weeks per size (exercises cleanup)")
+    parser.add_argument('--carry-over', type=float, default=0.0, help="share of tracks kept from one week to the next")
+    parser.add_argument('--library', type=int, default=5000, help="number of songs already in the fake library")
+    parser.add_argument('--latency', type=float, default=0.0, help="average latency of every fake call (s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of Subsonic calls answering 503")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="share of Subsonic calls 20x slower than --latency")
+    parser.add_argument('--download-delay', type=float, default=0.05, help="Octo-Fiesta download duration (s)")
+    parser.add_argument('--scan-duration', type=float, default=0.2, help="library scan duration (s)")
+    parser.add_argument('--rate', type=float, default=1000, help="starting rate limit of every upstream (req/s)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--tracemalloc', action='store_true', help="also report Python peak allocations (slower)")
+    parser.add_argument('--json', help="write raw results to this file")
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        return run_scenario(args, args.run_one)
+
+    all_results = []
+    for size in args.tracks:
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp:
+            result_path = tmp.name
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-one', result_path]
+        for arg in sys.argv[1:]:
+            cmd.append(arg)
+        cmd += ['--tracks', str(size)]
+        subprocess.run(cmd, check=True)
+        with open(result_path, 'r', encoding='utf-8') as f:
+            all_results.extend(json.load(f))
+        os.remove(result_path)
+    print_report(all_results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(all_results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import time
+import daemon
+import logging
+
+try:
+    import fcntl
+except ImportError: # Windows: no cross-process lock, runs are not serialized
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# Several invocations may share one STATE_DB (cron overlap, manual run during a scheduled one, daemon).
+# RunLock lets one run at a time through (flock on a file next to the database): the others wait for it,
+# then find the playlist processed and reuse its result instead of downloading and scanning everything twice.
+
+class RunLock:
+    """Exclusive lock held for a whole run. Usable as `with RunLock(path, wait) as locked:`."""
+    def __init__(self, path, wait=0):
+        self.path = path
+        self.wait = wait
+        self._fd = None
+
+    def _holder(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return f.read().strip() or "?"
+        except OSError:
+            return "?"
+
+    def acquire(self):
+        """Takes the lock, waiting up to `wait` seconds for the running process. False when it is still busy."""
+        if fcntl is None:
+            return True
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        start = time.monotonic()
+        logged = False
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not logged:
+                    log.info("Another run is in progress (pid %s): waiting up to %ss for it to finish.", self._holder(), self.wait)
+                    logged = True
+                if time.monotonic() - start >= self.wait or daemon.stop_requested():
+                    os.close(self._fd)
+                    self._fd = None
+                    return False
+                time.sleep(1)
+        os.ftruncate(self._fd, 0)
+        os.write(self._fd, str(os.getpid()).encode())
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            # the file stays: removing it would let a waiting process lock an unlinked inode
+            os.ftruncate(self._fd, 0)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
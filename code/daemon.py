@@ -0,0 +1,63 @@
+import random
+import signal
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# Set by SIGTERM/SIGINT, checked by the pipeline between tracks and between steps
+_stop = threading.Event()
+
+def stop_requested():
+    """True once a shutdown signal has been received."""
+    return _stop.is_set()
+
+def request_stop():
+    _stop.set()
+
+def sleep(seconds):
+    """time.sleep() that returns as soon as a shutdown signal is received."""
+    _stop.wait(seconds)
+
+def _handle_signal(signum, frame):
+    log.info("Signal %s received: finishing the current track then shutting down (send it again to force quit).",
+             signal.Signals(signum).name)
+    _stop.set()
+    # A second signal falls back to the default behaviour (immediate exit)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+def install_signal_handlers():
+    signal.signal(signal.SIGTERM, _handle_signal)
+    signal.signal(signal.SIGINT, _handle_signal)
+
+def next_delay(interval, jitter):
+    """Poll interval with +/- jitter so several instances don't hit ListenBrainz at the same second."""
+    if jitter <= 0:
+        return interval
+    return max(1.0, interval + random.uniform(-jitter, jitter))
+
+def run(poll, sync, interval, jitter):
+    """
+    Stays resident and polls ListenBrainz on a schedule.
+    poll() returns the playlist info when a new playlist is available (None otherwise),
+    sync(playlist_info) runs the whole pipeline in this warm process.
+    """
+    install_signal_handlers()
+    log.info("Daemon mode: polling every %ss (+/- %ss). Ctrl+C / SIGTERM to stop.", interval, jitter)
+    while not _stop.is_set():
+        started = time.monotonic()
+        try:
+            playlist_info = poll()
+            if playlist_info:
+                sync(playlist_info)
+        except Exception as e:
+            # A failed run must not kill the daemon, the next poll will retry
+            log.warning("Daemon: run failed: %s", e)
+        if _stop.is_set():
+            break
+        delay = next_delay(interval, jitter)
+        log.info("Daemon: next poll in %.0fs (last cycle took %.1fs)", delay, time.monotonic() - started)
+        _stop.wait(delay)
+    log.info("Daemon stopped.")
@@ -0,0 +1,180 @@
+import threading
+import time
+from contextlib import contextmanager
+import logging
+
+log = logging.getLogger(__name__)
+
+# Run-wide time limits shared by every network call:
+#  - a run deadline (RUN_TIMEOUT) and one budget per step (STAGE_BUDGETS)
+#  - a global retry budget: once spent, failed calls are not retried anymore
+#  - one circuit breaker per upstream: after N consecutive failures the upstream
+#    is considered down and calls fail fast until the cooldown is over
+# A refused call leaves the run incomplete: cut_short() tells the pipeline to stop instead of
+# taking the missing answers for "not found".
+
+_lock = threading.Lock()
+_config = {
+    'run_timeout': 0,       # seconds, 0 = no limit
+    'stage_budgets': {},    # stage name -> seconds
+    'retry_budget': 30,
+    'breaker_threshold': 5,
+    'breaker_cooldown': 120,
+}
+_run_deadline = None
+_stage_deadline = None
+_stage_name = None
+_retries_left = 0
+_failures = {}      # upstream -> consecutive failures
+_open_until = {}    # upstream -> monotonic time until which calls fail fast
+_cut_short = None   # why the first call of the run was refused (None: nothing was refused)
+
+def configure(run_timeout=0, stage_budgets=None, retry_budget=30, breaker_threshold=5, breaker_cooldown=120):
+    _config.update({
+        'run_timeout': run_timeout,
+        'stage_budgets': dict(stage_budgets or {}),
+        'retry_budget': retry_budget,
+        'breaker_threshold': breaker_threshold,
+        'breaker_cooldown': breaker_cooldown,
+    })
+
+def parse_budgets(text):
+    """Parses 'search=1800,youtube_fallback=2400' into a dict of seconds."""
+    budgets = {}
+    for part in (text or "").split(','):
+        if '=' not in part:
+            continue
+        name, value = part.split('=', 1)
+        try:
+            budgets[name.strip()] = float(value)
+        except ValueError:
+            log.warning("Warning: invalid stage budget '%s' ignored", part)
+    return budgets
+
+def start_run():
+    """Arms the run deadline and resets the retry budget and the breakers."""
+    global _run_deadline, _stage_deadline, _stage_name, _retries_left, _cut_short
+    with _lock:
+        timeout = _config['run_timeout']
+        _run_deadline = time.monotonic() + timeout if timeout else None
+        _stage_deadline = None
+        _stage_name = None
+        _retries_left = _config['retry_budget']
+        _failures.clear()
+        _open_until.clear()
+        _cut_short = None
+
+def stop_run():
+    """Disarms the run deadline (daemon mode: polling between two runs is not limited)."""
+    global _run_deadline, _stage_deadline
+    with _lock:
+        _run_deadline = None
+        _stage_deadline = None
+
+@contextmanager
+def stage(name):
+    """Applies the configured budget of a step (never beyond the run deadline)."""
+    global _stage_deadline, _stage_name
+    budget = _config['stage_budgets'].get(name)
+    _stage_name = name
+    _stage_deadline = time.monotonic() + budget if budget else None
+    try:
+        yield
+    finally:
+        _stage_deadline = None
+        _stage_name = None
+
+def remaining():
+    """Seconds left before the closest deadline (stage or run), None when unlimited."""
+    deadlines = [d for d in (_run_deadline, _stage_deadline) if d is not None]
+    if not deadlines:
+        return None
+    return min(deadlines) - time.monotonic()
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+def run_expired():
+    return _run_deadline is not None and time.monotonic() >= _run_deadline
+
+def clamp(timeout):
+    """Network timeout bounded by the time left (at least 1s so a call is never sent with 0)."""
+    left = remaining()
+    if left is None:
+        return timeout
+    return max(1.0, min(timeout, left))
+
+def describe():
+    if run_expired():
+        return "run deadline reached"
+    return f"time budget of step '{_stage_name}' exhausted"
+
+# --- Retry budget & breakers ---
+
+def is_open(upstream):
+    """True when the upstream breaker is open (calls must fail fast)."""
+    with _lock:
+        until = _open_until.get(upstream)
+        if until is None:
+            return False
+        if time.monotonic() >= until:
+            # half-open: let one call through, it closes or re-opens the breaker
+            del _open_until[upstream]
+            _failures[upstream] = _config['breaker_threshold'] - 1
+            return False
+        return True
+
+def _refuse(upstream, reason):
+    global _cut_short
+    with _lock:
+        if _cut_short is None:
+            _cut_short = f"[{upstream}] {reason}"
+
+def cut_short():
+    """Why a call was refused during this run (deadline, step budget, breaker), None if none was."""
+    return _cut_short
+
+def can_call(upstream):
+    """Checks deadline and breaker before a network call, prints why it is refused."""
+    if expired():
+        log.info("[%s] call skipped: %s", upstream, describe())
+        _refuse(upstream, describe())
+        return False
+    if is_open(upstream):
+        log.info("[%s] call skipped: upstream marked as down (circuit breaker open)", upstream)
+        _refuse(upstream, "upstream marked as down (circuit breaker open)")
+        return False
+    return True
+
+def record_success(upstream):
+    with _lock:
+        _failures[upstream] = 0
+
+def record_failure(upstream):
+    with _lock:
+        _failures[upstream] = _failures.get(upstream, 0) + 1
+        if _failures[upstream] >= _config['breaker_threshold'] and upstream not in _open_until:
+            _open_until[upstream] = time.monotonic() + _config['breaker_cooldown']
+            log.warning("[%s] %s consecutive failures: failing fast for %ss", upstream, _failures[upstream], _config['breaker_cooldown'])
+
+def allow_retry(upstream, wait=0):
+    """Consumes one retry from the run budget. Refused if the budget, the deadline or the breaker says no."""
+    global _retries_left
+    left = remaining()
+    if left is not None and left <= wait:
+        _refuse(upstream, "not enough time left to retry")
+        return False
+    with _lock:
+        if _retries_left <= 0:
+            if upstream not in _open_until:
+                _open_until[upstream] = time.monotonic() + _config['breaker_cooldown']
+                log.info("[%s] retry budget of the run exhausted: failing fast", upstream)
+            reason = "retry budget of the run exhausted"
+        elif upstream in _open_until:
+            reason = "upstream marked as down (circuit breaker open)"
+        else:
+            _retries_left -= 1
+            return True
+    _refuse(upstream, reason)
+    return False
@@ -0,0 +1,421 @@
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-ins for ListenBrainz, Subsonic/Navidrome + Octo-Fiesta and yt-dlp.
+# Used by bench.py to replay synthetic weeks through main.main() without any real service.
+
+SYLLABLES = ["ka", "lo", "mi", "ren", "to", "sa", "vel", "dor", "na", "ri", "zu", "po", "che", "lan", "mo", "tes",
+             "bra", "qui", "fen", "jo", "xa", "ul", "ny", "gor"]
+
+def _word(rng, parts=(2, 3)):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(*parts))).capitalize()
+
+def _name(rng, words=(1, 3)):
+    return " ".join(_word(rng) for _ in range(rng.randint(*words)))
+
+def _tokens(text):
+    return set(re.findall(r"\w+", (text or "").lower()))
+
+
+class World:
+    """
+    The whole fake universe: local library, Octo-Fiesta external catalogue, YouTube catalogue
+    and one synthetic ListenBrainz playlist per week.
+    """
+    def __init__(self, library_size=2000, seed=42, local_ratio=0.4, external_ratio=0.4, youtube_ratio=0.15):
+        self.rng = random.Random(seed)
+        self.lock = threading.RLock()
+        self.local_ratio = local_ratio
+        self.external_ratio = external_ratio
+        self.youtube_ratio = youtube_ratio
+        self.songs = {}        # id -> song dict (Subsonic format)
+        self._index = {}       # token -> set of song ids
+        self.youtube = []      # fake YouTube videos
+        self.weeks = []        # list of (playlist info, tracks)
+        self.playlists = {}    # id -> {'name', 'entries'}
+        self.starred = set()
+        self.pending = {}      # file path -> external song waiting for a scan
+        self.video_durations = {} # file path -> duration of the YouTube video it was downloaded from
+        self.scanning_until = 0.0
+        self.download_dir = None
+        self._next_id = 0
+        artists = [_name(self.rng) for _ in range(max(1, library_size // 10))]
+        for _ in range(library_size):
+            self.add_song(self.rng.choice(artists), _name(self.rng), _name(self.rng, (1, 2)), external=False)
+        for song_id in self.rng.sample(list(self.songs), k=min(len(self.songs), max(1, library_size // 50))):
+            self.starred.add(song_id)
+
+    def _new_id(self, prefix):
+        self._next_id += 1
+        return f"{prefix}-{self._next_id}"
+
+    def add_song(self, artist, title, album, external, path=None, mbid=None, duration=None):
+        with self.lock:
+            song_id = self._new_id("ext" if external else "loc")
+            song = {
+                'id': song_id,
+                'title': title,
+                'artist': artist,
+                'album': album,
+                'isExternal': external,
+                'duration': duration or self.rng.randint(120, 300),
+                'path': path or f"{artist}/{album}/{title}.flac",
+                'musicBrainzId': mbid or str(uuid.UUID(int=self.rng.getrandbits(128))),
+                'playCount': self.rng.randint(0, 20),
+                'size': self.rng.randint(3, 12) * 2**20,
+            }
+            if song['playCount']:
+                song['played'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - self.rng.randint(0, 90) * 86400))
+            self.songs[song_id] = song
+            for token in _tokens(f"{artist} {title} {album}"):
+                self._index.setdefault(token, set()).add(song_id)
+            return song
+
+    def search(self, query, count, offset=0):
+        """AND full-text search, like Navidrome (an empty query lists every song)."""
+        tokens = _tokens(query)
+        with self.lock:
+            if not tokens:
+                ids = list(self.songs)
+            else:
+                postings = sorted((self._index.get(t, set()) for t in tokens), key=len)
+                ids = set(postings[0]).intersection(*postings[1:]) if postings else set()
+            # local songs first, stable order
+            found = sorted((self.songs[i] for i in ids), key=lambda s: (s['isExternal'], s['id']))
+        return found[offset:offset + count]
+
+    def new_week(self, size, carry_over=0.0):
+        """Builds the next weekly playlist of `size` tracks (a share can be carried over from last week)."""
+        rng = self.rng
+        date = time.strftime("%Y-%m-%d", time.gmtime(time.time() + len(self.weeks) * 7 * 86400))
+        tracks = []
+        if self.weeks and carry_over:
+            previous = self.weeks[-1][1]
+            tracks.extend(rng.sample(previous, k=min(len(previous), int(size * carry_over))))
+        locals_ = [s for s in self.songs.values() if not s['isExternal']]
+        while len(tracks) < size:
+            kind = rng.random()
+            if kind < self.local_ratio and locals_:
+                song = rng.choice(locals_)
+                track = {'artist': song['artist'], 'title': song['title'], 'album': song['album'],
+                         'mbid': song['musicBrainzId'], 'duration': song['duration']}
+            else:
+                track = {'artist': _name(rng), 'title': _name(rng), 'album': _name(rng, (1, 2)),
+                         'mbid': str(uuid.UUID(int=rng.getrandbits(128))), 'duration': rng.randint(120, 300)}
+                if kind < self.local_ratio + self.external_ratio:
+                    self.add_song(track['artist'], track['title'], track['album'], external=True,
+                                  mbid=track['mbid'], duration=track['duration'])
+                elif kind < self.local_ratio + self.external_ratio + self.youtube_ratio:
+                    self.add_video(track)
+                # else: nowhere to be found
+            tracks.append(track)
+        info = {'mbid': str(uuid.UUID(int=rng.getrandbits(128))), 'date': f"{date}T00:00:00+00:00"}
+        self.weeks.append((info, tracks))
+        return info, tracks
+
+    def add_video(self, track):
+        vid = uuid.UUID(int=self.rng.getrandbits(128)).hex[:11]
+        self.youtube.append({'id': vid, 'title': f"{track['artist']} - {track['title']} (Official Audio)",
+                             'uploader': f"{track['artist']} - Topic", 'duration': track['duration']})
+        # a live version nearby, the matcher should not prefer it
+        self.youtube.append({'id': vid[::-1], 'title': f"{track['artist']} - {track['title']} (Live at {_word(self.rng)})",
+                             'uploader': _name(self.rng), 'duration': track['duration'] + 400})
+
+    # --- Octo-Fiesta / Navidrome behaviour ---
+
+    def trigger_download(self, song_id, delay):
+        """Octo-Fiesta: streaming an external song downloads it into the library folder."""
+        song = self.songs.get(song_id)
+        if not song or not song['isExternal'] or not self.download_dir:
+            return
+        def write():
+            time.sleep(delay)
+            folder = os.path.join(self.download_dir, song['artist'], song['album'])
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, f"{song['title']}.mp3")
+            tmp = path + ".tmp"
+            with open(tmp, 'wb') as f:
+                f.write(os.urandom(2048))
+            os.replace(tmp, path)
+            with self.lock:
+                self.pending[path] = song
+        threading.Thread(target=write, daemon=True).start()
+
+    def scan(self, duration):
+        """Indexes every new audio file of the download folder as a local song."""
+        with self.lock:
+            self.scanning_until = time.monotonic() + duration
+            if not self.download_dir:
+                return
+            known = {s['path'] for s in self.songs.values() if not s['isExternal']}
+            for dirpath, _, filenames in os.walk(self.download_dir):
+                for name in filenames:
+                    if not name.endswith(('.mp3', '.flac', '.m4a', '.opus')):
+                        continue
+                    full = os.path.join(dirpath, name)
+                    rel = os.path.relpath(full, self.download_dir)
+                    if rel in known:
+                        continue
+                    origin = self.pending.pop(full, None)
+                    if origin:
+                        self.add_song(origin['artist'], origin['title'], origin['album'], external=False, path=rel,
+                                      mbid=origin['musicBrainzId'], duration=origin['duration'])
+                    else:
+                        # YouTube file: <artist>/<title>.mp3
+                        artist = os.path.basename(dirpath)
+                        title = os.path.splitext(name)[0]
+                        self.add_song(artist, title, "YouTube", external=False, path=rel,
+                                      duration=self.video_durations.pop(full, None))
+
+    def scanning(self):
+        return time.monotonic() < self.scanning_until
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _params(self):
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        if self.command == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            params.update(parse_qs(self.rfile.read(length).decode('utf-8')))
+        return parsed.path, params
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        server = self.server
+        path, params = self._params()
+        endpoint = path.rstrip('/').split('/')[-1]
+        server.count(endpoint)
+        if server.latency:
+            # a share of the calls hit a slow external provider (tail latency)
+            slow = server.slow_rate and server.rng.random() < server.slow_rate
+            time.sleep(server.latency * server.rng.uniform(0.5, 1.5) * (20 if slow else 1))
+        if server.error_rate and server.rng.random() < server.error_rate:
+            return self._send(503, b"overloaded", 'text/plain')
+        self.server.route(self, path, endpoint, params)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class _FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, world, latency=0.0, error_rate=0.0, slow_rate=0.0):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.world = world
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.rng = random.Random(7)
+        self.requests = {}
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, endpoint):
+        with self._count_lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSubsonic(_FakeServer):
+    """search3, stream, startScan/getScanStatus, playlists, starred, getSong."""
+    def __init__(self, world, latency=0.0, error_rate=0.0, download_delay=0.05, scan_duration=0.2, slow_rate=0.0):
+        super().__init__(world, latency, error_rate, slow_rate)
+        self.download_delay = download_delay
+        self.scan_duration = scan_duration
+
+    @staticmethod
+    def ok(payload=None):
+        body = {'status': 'ok', 'version': '1.16.1'}
+        body.update(payload or {})
+        return {'subsonic-response': body}
+
+    @staticmethod
+    def failed(code, message):
+        return {'subsonic-response': {'status': 'failed', 'version': '1.16.1', 'error': {'code': code, 'message': message}}}
+
+    def route(self, handler, path, endpoint, params):
+        world = self.world
+        first = lambda key, default=None: params.get(key, [default])[0]
+        if endpoint == 'search3':
+            songs = world.search(first('query', ''), int(first('songCount', 20)), int(first('songOffset', 0)))
+            return handler._send(200, self.ok({'searchResult3': {'song': songs} if songs else {}}))
+        if endpoint == 'stream':
+            world.trigger_download(first('id'), self.download_delay)
+            return handler._send(200, os.urandom(4096), 'audio/mpeg')
+        if endpoint == 'startScan':
+            world.scan(self.scan_duration)
+            return handler._send(200, self.ok({'scanStatus': {'scanning': True, 'count': len(world.songs)}}))
+        if endpoint == 'getScanStatus':
+            return handler._send(200, self.ok({'scanStatus': {'scanning': world.scanning(), 'count': len(world.songs)}}))
+        if endpoint == 'getSong':
+            song = world.songs.get(first('id'))
+            if not song:
+                return handler._send(200, self.failed(70, "Song not found"))
+            return handler._send(200, self.ok({'song': song}))
+        if endpoint == 'getStarred':
+            songs = [world.songs[i] for i in world.starred if i in world.songs]
+            return handler._send(200, self.ok({'starred': {'song': songs}}))
+        if endpoint == 'getPlaylists':
+            playlists = [{'id': pid, 'name': p['name'], 'songCount': len(p['entries'])} for pid, p in world.playlists.items()]
+            return handler._send(200, self.ok({'playlists': {'playlist': playlists}}))
+        if endpoint == 'getPlaylist':
+            playlist = world.playlists.get(first('id'))
+            if playlist is None:
+                return handler._send(200, self.failed(70, "Playlist not found"))
+            return handler._send(200, self.ok({'playlist': self._playlist_body(first('id'), playlist)}))
+        if endpoint == 'createPlaylist':
+            with world.lock:
+                pid = first('playlistId') or world._new_id("pl")
+                playlist = world.playlists.setdefault(pid, {'name': first('name', pid), 'entries': []})
+                playlist['entries'] = [i for i in params.get('songId', []) if i in world.songs]
+            return handler._send(200, self.ok({'playlist': self._playlist_body(pid, playlist)}))
+        if endpoint == 'updatePlaylist':
+            with world.lock:
+                playlist = world.playlists.get(first('playlistId'))
+                if playlist is None:
+                    return handler._send(200, self.failed(70, "Playlist not found"))
+                if first('name'):
+                    playlist['name'] = first('name')
+                remove = {int(i) for i in params.get('songIndexToRemove', [])}
+                playlist['entries'] = [s for n, s in enumerate(playlist['entries']) if n not in remove]
+                playlist['entries'].extend(i for i in params.get('songIdToAdd', []) if i in world.songs)
+            return handler._send(200, self.ok())
+        if endpoint == 'deletePlaylist':
+            with world.lock:
+                world.playlists.pop(first('id'), None)
+            return handler._send(200, self.ok())
+        return handler._send(404, b"unknown endpoint", 'text/plain')
+
+    def _playlist_body(self, pid, playlist):
+        entries = [self.world.songs[i] for i in playlist['entries'] if i in self.world.songs]
+        return {'id': pid, 'name': playlist['name'], 'songCount': len(entries), 'entry': entries}
+
+
+class FakeListenBrainz(_FakeServer):
+    """/1/user/<user>/playlists/createdfor and /1/playlist/<mbid> (JSPF)."""
+    def route(self, handler, path, endpoint, params):
+        world = self.world
+        if path.endswith('/playlists/createdfor'):
+            playlists = [{'playlist': {'identifier': f"https://listenbrainz.org/playlist/{info['mbid']}",
+                                       'date': info['date'], 'title': "Weekly Exploration"}}
+                         for info, _ in reversed(world.weeks)]
+            return handler._send(200, {'playlists': playlists})
+        for info, tracks in world.weeks:
+            if path.endswith(f"/playlist/{info['mbid']}"):
+                return handler._send(200, {'playlist': {'track': [self._jspf(t) for t in tracks]}})
+        return handler._send(404, {'error': 'not found'})
+
+    @staticmethod
+    def _jspf(track):
+        return {
+            'creator': track['artist'],
+            'title': track['title'],
+            'album': track['album'],
+            'duration': track['duration'] * 1000,
+            'identifier': [f"https://musicbrainz.org/recording/{track['mbid']}"],
+            'extension': {'https://musicbrainz.org/doc/jspf#track': {'additional_metadata': {
+                'artists': [{'artist_credit_name': track['artist'], 'artist_mbid': str(uuid.uuid5(uuid.NAMESPACE_URL, track['artist']))}]
+            }}},
+        }
+
+
+class FakeYoutube:
+    """Stubbed yt-dlp: flat search results from the fake catalogue, downloads write a small mp3."""
+    def __init__(self, world, latency=0.0):
+        self.world = world
+        self.latency = latency
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def install(self):
+        """Registers a fake `yt_dlp` module (youtube.py imports it lazily)."""
+        fake = self
+        module = types.ModuleType('yt_dlp')
+        utils = types.ModuleType('yt_dlp.utils')
+
+        class DownloadCancelled(Exception):
+            pass
+
+        class YoutubeDL:
+            def __init__(self, opts=None):
+                self.opts = opts or {}
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def extract_info(self, query, download=False):
+                fake.count('search')
+                time.sleep(fake.latency)
+                match = re.match(r"ytsearch(\d*):(.*)", query)
+                limit = int(match.group(1) or 1) if match else 1
+                tokens = _tokens(match.group(2) if match else query) - {'audio', 'lyrics'}
+                entries = [dict(v) for v in fake.world.youtube if tokens and tokens <= _tokens(v['title'] + ' ' + v['uploader'])]
+                return {'entries': entries[:limit]}
+
+            def download(self, urls):
+                fake.count('download')
+                time.sleep(fake.latency)
+                path = self.opts['outtmpl'].replace('%(ext)s', 'mp3')
+                video_id = urls[0].rsplit('=', 1)[-1]
+                video = next((v for v in fake.world.youtube if v['id'] == video_id), None)
+                if video:
+                    fake.world.video_durations[path] = video['duration']
+                for hook in self.opts.get('progress_hooks', []):
+                    hook({'status': 'downloading'})
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(2048))
+                for hook in self.opts.get('postprocessor_hooks', []):
+                    hook({'status': 'started'})
+                return 0
+
+        utils.DownloadCancelled = DownloadCancelled
+        module.utils = utils
+        module.YoutubeDL = YoutubeDL
+        sys.modules['yt_dlp'] = module
+        sys.modules['yt_dlp.utils'] = utils
+        return module
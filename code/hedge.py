@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+
+log = logging.getLogger(__name__)
+
+# Hedged requests: when an idempotent call has not answered by the p95 latency observed for its
+# endpoint, a duplicate is sent and the first answer wins. Extra load is capped to a share of the calls.
+
+_enabled = False
+_max_ratio = 0.1      # at most this many hedges per call
+_min_samples = 20     # no hedging before the p95 is meaningful
+_min_delay = 0.05     # never hedge sooner than this (s)
+_window = 200         # latencies kept per endpoint
+
+_lock = threading.Lock()
+_latencies = {}       # endpoint -> deque of recent latencies (s)
+_credit = 0.0         # hedges allowed right now (+max_ratio per call, -1 per hedge)
+_pool = None
+stats = {'calls': 0, 'hedged': 0, 'hedge_won': 0}
+
+def configure(enabled, max_ratio=0.1, min_samples=20):
+    global _enabled, _max_ratio, _min_samples
+    _enabled = enabled
+    _max_ratio = max_ratio
+    _min_samples = min_samples
+
+def record(endpoint, latency):
+    with _lock:
+        samples = _latencies.get(endpoint)
+        if samples is None:
+            samples = _latencies[endpoint] = deque(maxlen=_window)
+        samples.append(latency)
+
+def p95(endpoint):
+    """95th percentile latency of the endpoint, None while there are not enough samples."""
+    with _lock:
+        samples = sorted(_latencies.get(endpoint, ()))
+    if len(samples) < _min_samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+def _take_credit():
+    global _credit
+    with _lock:
+        if _credit >= 1.0:
+            _credit -= 1.0
+            return True
+        return False
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+        return _pool
+
+def _timed(endpoint, fn):
+    start = time.monotonic()
+    result = fn()
+    record(endpoint, time.monotonic() - start)
+    return result
+
+def call(endpoint, fn, before_hedge=None, ok=None):
+    """
+    Runs fn() (an idempotent request) and returns its result. When hedging is enabled and fn() is slower
+    than the endpoint's p95, a second fn() is started (before_hedge() is called first, e.g. to take a
+    rate limit token) and the first one to succeed wins: no exception, and ok(result) when ok is given
+    (a fast 503 must not beat a slower 200). When both fail, the first failure is returned or raised.
+    The slower call is left to finish in the background.
+    """
+    global _credit
+    with _lock:
+        stats['calls'] += 1
+        _credit = min(_credit + _max_ratio, 10.0)
+    delay = p95(endpoint) if _enabled else None
+    if delay is None:
+        return _timed(endpoint, fn)
+
+    pool = _get_pool()
+    first = pool.submit(_timed, endpoint, fn)
+    done, _ = wait([first], timeout=max(delay, _min_delay))
+    if done or not _take_credit():
+        return first.result()
+
+    if before_hedge:
+        before_hedge()
+    with _lock:
+        stats['hedged'] += 1
+    log.debug("[hedge] %s slower than p95 (%.2fs): duplicate sent", endpoint, delay)
+    second = pool.submit(_timed, endpoint, fn)
+    pending = {first, second}
+    failed = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and (ok is None or ok(future.result())):
+                if future is second:
+                    with _lock:
+                        stats['hedge_won'] += 1
+                return future.result()
+            failed = failed or future
+    return failed.result()
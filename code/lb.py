@@ -1,32 +1,66 @@
-import requests
+import json
+import urllib.request
+import urllib.error
+import time
+import ratelimit
+import deadline
+import replay
 from datetime import datetime
+from models import Track
+import logging
+
+log = logging.getLogger(__name__)
+
+def lb_get_json(url, timeout=30):
+    """
+    Performs a GET request to the ListenBrainz API and decodes the JSON body.
+    Uses the standard library only so the 'already processed' path stays cheap to start.
+    """
+    req = urllib.request.Request(url, headers={'Accept': 'application/json', 'User-Agent': 'octo-discovery'})
+    if not deadline.can_call('listenbrainz'):
+        raise TimeoutError(deadline.describe())
+    ratelimit.acquire('listenbrainz')
+    start = time.monotonic()
+    try:
+        with replay.urlopen(req, timeout=deadline.clamp(timeout)) as r:
+            body = r.read()
+            ratelimit.feedback('listenbrainz', status=r.status, latency=time.monotonic() - start)
+    except urllib.error.HTTPError as e:
+        deadline.record_failure('listenbrainz')
+        ratelimit.feedback('listenbrainz', status=e.code,
+                           retry_after=ratelimit.parse_retry_after(e.headers.get('Retry-After')))
+        raise
+    except OSError:
+        deadline.record_failure('listenbrainz')
+        ratelimit.feedback('listenbrainz', error=True)
+        raise
+    deadline.record_success('listenbrainz')
+    return json.loads(body.decode('utf-8'))
 
 def get_weekly_playlist_infos(LB_BASE_URL, LB_USER):
     url = f"{LB_BASE_URL}/1/user/{LB_USER}/playlists/createdfor"
     try:
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
-        data = r.json()
+        data = lb_get_json(url, timeout=30)
         playlists = data.get("playlists", [])
         if not playlists:
-            print("ListenBrainz: no playlist found in 'createdfor'")
+            log.warning("ListenBrainz: no playlist found in 'createdfor'")
             return None
 
         last_playlist = playlists[0].get("playlist")
         if not last_playlist:
-            print("ListenBrainz: bad response format (missing 'playlist')")
+            log.warning("ListenBrainz: bad response format (missing 'playlist')")
             return None
 
         identifier = last_playlist.get("identifier", "")
         if not identifier:
-            print("ListenBrainz: missing identifier")
+            log.warning("ListenBrainz: missing identifier")
             return None
 
         mbid = identifier.split("/")[-1]
 
         playlist_date = last_playlist.get("date")
         if not playlist_date:
-            print("ListenBrainz: missing date")
+            log.warning("ListenBrainz: missing date")
             return None
 
         dt_playlist = datetime.fromisoformat(playlist_date)
@@ -34,20 +68,38 @@ def get_weekly_playlist_infos(LB_BASE_URL, LB_USER):
         name = f"{date} Weekly Discovery"
         return {"mbid": mbid, "name": name}
     
-    except requests.exceptions.RequestException as e:
-        print(f"ListenBrainz network/http error: {e}")
+    except (urllib.error.URLError, OSError) as e:
+        log.warning("ListenBrainz network/http error: %s", e)
         return None
     except ValueError as e:
-        print(f"ListenBrainz JSON/date parse error: {e}")
+        log.warning("ListenBrainz JSON/date parse error: %s", e)
         return None
 
 
+def _mbid_from_url(url, kind):
+    """'https://musicbrainz.org/recording/<mbid>' -> '<mbid>' (None for another kind of URL)."""
+    prefix = f"musicbrainz.org/{kind}/"
+    if not url or prefix not in url:
+        return None
+    return url.split(prefix, 1)[1].strip('/') or None
+
+def parse_mbids(track):
+    """Recording MBID and artist MBIDs of a JSPF track (identifier can be a string or a list)."""
+    identifiers = track.get('identifier') or []
+    if isinstance(identifiers, str):
+        identifiers = [identifiers]
+    recording = next((m for m in (_mbid_from_url(i, 'recording') for i in identifiers) if m), None)
+
+    meta = (track.get('extension') or {}).get('https://musicbrainz.org/doc/jspf#track') or {}
+    artists = [_mbid_from_url(i, 'artist') for i in meta.get('artist_identifiers') or []]
+    if not any(artists):
+        artists = [a.get('artist_mbid') for a in (meta.get('additional_metadata') or {}).get('artists') or []]
+    return recording, tuple(a for a in artists if a)
+
 def get_song_in_playlist(mbid, LB_BASE_URL):
     url = f"{LB_BASE_URL}/1/playlist/{mbid}"
     try:
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        data = lb_get_json(url, timeout=30)
         playlist = data["playlist"]
         tracks = playlist.get("track", [])
         # print(f"Number of tracks : {len(tracks)}")
@@ -55,17 +107,13 @@ def get_song_in_playlist(mbid, LB_BASE_URL):
         lb_track_list = []
 
         for track in tracks:
-            artist = track['creator']
-            title = track['title']
-            album = track.get('album','')
-            track_append = {
-                'artist': artist,
-                'title': title,
-                'album': album
-            }
-            lb_track_list.append(track_append)
+            # JSPF duration is in milliseconds
+            duration = track.get('duration')
+            recording_mbid, artist_mbids = parse_mbids(track)
+            lb_track_list.append(Track(track['creator'], track['title'], track.get('album', ''),
+                                       round(duration / 1000) if duration else None, recording_mbid, artist_mbids))
         return lb_track_list
 
     except Exception as e:
-        print(f"Error : {e}")
+        log.warning("Error : %s", e)
         return None
@@ -0,0 +1,54 @@
+import json
+import logging
+import sys
+import time
+
+# Logging setup shared by every module (each module uses logging.getLogger(__name__)).
+# Console output keeps the plain "message only" look of the script, an optional
+# JSON lines sink (one object per record) can be added for log collectors.
+
+class _StdoutHandler(logging.StreamHandler):
+    """Always writes to the current sys.stdout (works with contextlib.redirect_stdout)."""
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.args and isinstance(record.args, tuple):
+            entry['args'] = [a if isinstance(a, (int, float, str, bool, type(None))) else repr(a) for a in record.args]
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup(level="INFO", json_path=None):
+    """Configures the root logger: console (stdout) + optional JSON lines file."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+    console = _StdoutHandler()
+    console.setFormatter(logging.Formatter("%(message)s"))
+    root.addHandler(console)
+
+    if json_path:
+        sink = logging.FileHandler(json_path, encoding='utf-8')
+        sink.setFormatter(JsonFormatter())
+        root.addHandler(sink)
+    # third party chatter stays out of our logs unless explicitly in debug
+    logging.getLogger("urllib3").setLevel(max(root.level, logging.WARNING))
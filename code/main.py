@@ -1,10 +1,23 @@
 import lb
-import subsonic
 from dotenv import load_dotenv
 import os
-import json
-import youtube
-import time
+import state
+import ratelimit
+import deadline
+import hedge
+import replay
+import watcher
+import profiling
+import daemon
+import coordinator
+import utility
+from models import Candidate
+import logs
+import logging
+# subsonic (requests) and youtube (yt_dlp) are imported lazily inside run_pipeline():
+# the weekly "already processed" check must stay cheap for cron runs.
+
+log = logging.getLogger(__name__)
 
 load_dotenv()
 
@@ -16,254 +29,534 @@ SUBSONIC_URL = os.getenv('SUBSONIC_URL')
 LOCAL_DOWNLOAD_PATH = os.getenv('LOCAL_DOWNLOAD_PATH')
 YOUTUBE_FALLBACK = os.getenv('YOUTUBE_FALLBACK', 'true').lower() == 'true'
 CLEANUP_DOWNLOADS = os.getenv('CLEANUP_DOWNLOADS', 'true').lower() == 'true'
-
-def main():
-# --- STEP 0: INITIALIZATION & CHECK ---
-    # Fetch playlist info from ListenBrainz and check if we already processed it
-    playlist_info = lb.get_weekly_playlist_infos(LB_BASE_URL, LB_USER)
-    if not playlist_info:
-        print("CRITICAL: Can't get playlist info from ListenBrainz")
-        return
-
-    playlist_name = playlist_info["name"]
-    mbid = playlist_info["mbid"]
-
-    old_data = None
-
-    if os.path.exists('data.json'):
+PROFILE = os.getenv('PROFILE', 'false').lower() == 'true'
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# Console verbosity (DEBUG shows every search candidate and its score) and optional JSON lines log file
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_JSON = os.getenv('LOG_JSON')
+DAEMON_MODE = os.getenv('DAEMON_MODE', 'false').lower() == 'true'
+POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', '3600'))
+POLL_JITTER = int(os.getenv('POLL_JITTER', '300'))
+STATE_DB = os.getenv('STATE_DB', 'state.db')
+# One run at a time per STATE_DB: a second invocation waits this long (s) for the running one, then reuses its result
+RUN_LOCK_WAIT = int(os.getenv('RUN_LOCK_WAIT', '3600'))
+# Requests per second allowed at start for each upstream (adapted at runtime from the server feedback)
+SUBSONIC_RATE = float(os.getenv('SUBSONIC_RATE', '10'))
+TRIGGER_RATE = float(os.getenv('TRIGGER_RATE', '0.5'))
+LB_RATE = float(os.getenv('LB_RATE', '2'))
+YOUTUBE_RATE = float(os.getenv('YOUTUBE_RATE', '1'))
+
+ratelimit.configure('subsonic', SUBSONIC_RATE, burst=5)
+ratelimit.configure('octo_trigger', TRIGGER_RATE, burst=1)
+ratelimit.configure('listenbrainz', LB_RATE, burst=2)
+ratelimit.configure('youtube', YOUTUBE_RATE, burst=2)
+
+# Time limits: whole run, per step, per YouTube download, and a retry budget shared by all network calls
+RUN_TIMEOUT = int(os.getenv('RUN_TIMEOUT', '7200'))
+STAGE_BUDGETS = os.getenv('STAGE_BUDGETS', 'search=1800,subsonic_download=1800,youtube_fallback=2400,cleanup=600,playlist=300')
+YT_DOWNLOAD_TIMEOUT = int(os.getenv('YT_DOWNLOAD_TIMEOUT', '300'))
+RETRY_BUDGET = int(os.getenv('RETRY_BUDGET', '30'))
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', '5'))
+
+deadline.configure(RUN_TIMEOUT, deadline.parse_budgets(STAGE_BUDGETS), RETRY_BUDGET, BREAKER_THRESHOLD)
+
+# Duplicate slow Subsonic reads (search3, getSong, getPlaylist, getScanStatus) after their observed p95
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', 'false').lower() == 'true'
+HEDGE_MAX_RATIO = float(os.getenv('HEDGE_MAX_RATIO', '0.1'))
+hedge.configure(HEDGE_REQUESTS, HEDGE_MAX_RATIO)
+
+# Offline regression runs: record every outbound call of a real run to a fixture, or replay one without network
+HTTP_RECORD = os.getenv('HTTP_RECORD', '')
+HTTP_REPLAY = os.getenv('HTTP_REPLAY', '')
+HTTP_REPLAY_TIMING = os.getenv('HTTP_REPLAY_TIMING', 'false').lower() == 'true'
+replay.configure(record=HTTP_RECORD, replay=HTTP_REPLAY, timing=HTTP_REPLAY_TIMING)
+if replay.active():
+    # nothing reaches the upstreams: no pacing, and no duplicate request eating fixture entries
+    ratelimit.set_enabled(False)
+    hedge.configure(False)
+
+# Wait for downloaded files to land in LOCAL_DOWNLOAD_PATH before scanning (inotify, polling fallback)
+WATCH_DOWNLOADS = os.getenv('WATCH_DOWNLOADS', 'true').lower() == 'true'
+DOWNLOAD_WAIT_TIMEOUT = int(os.getenv('DOWNLOAD_WAIT_TIMEOUT', '600'))
+DOWNLOAD_SETTLE = int(os.getenv('DOWNLOAD_SETTLE', '10'))
+# Songs sent per createPlaylist/updatePlaylist request (form-encoded POST, large playlists are split)
+PLAYLIST_CHUNK_SIZE = int(os.getenv('PLAYLIST_CHUNK_SIZE', '200'))
+# One broad search3 per artist appearing several times in the playlist, titles matched in memory
+SEARCH_BATCHING = os.getenv('SEARCH_BATCHING', 'true').lower() == 'true'
+# Search YouTube in the background while Octo-Fiesta downloads are pending (the fallback starts with a ready match)
+SPECULATIVE_YOUTUBE = os.getenv('SPECULATIVE_YOUTUBE', 'false').lower() == 'true'
+SPECULATIVE_WORKERS = int(os.getenv('SPECULATIVE_WORKERS', '2'))
+# Reuse tracks carried over from last week (no search, never cleaned up) and update the playlist in place
+WEEKLY_DIFF = os.getenv('WEEKLY_DIFF', 'true').lower() == 'true'
+# Disk budget of the files downloaded by the script (0 = delete last week's downloads every week)
+DISCOVERY_CACHE_MAX_MB = int(os.getenv('DISCOVERY_CACHE_MAX_MB', '0'))
+# Candidates (Subsonic songs, YouTube videos) whose duration differs more than this from ListenBrainz are rejected
+DURATION_TOLERANCE = int(os.getenv('DURATION_TOLERANCE', '30'))
+utility.configure(duration_tolerance=DURATION_TOLERANCE)
+# Resolve tracks by MusicBrainz recording id before any fuzzy search. The library index reads the whole
+# library (paged search3), rebuilt at most every MBID_INDEX_MAX_AGE days; previous matches are remembered in STATE_DB either way.
+MBID_MATCHING = os.getenv('MBID_MATCHING', 'true').lower() == 'true'
+MBID_LIBRARY_INDEX = os.getenv('MBID_LIBRARY_INDEX', 'false').lower() == 'true'
+MBID_INDEX_MAX_AGE = float(os.getenv('MBID_INDEX_MAX_AGE', '7'))
+
+def interrupted():
+    """
+    True when a shutdown signal was received (daemon mode), the run deadline is reached or a network call
+    was refused (step budget spent, upstream down): the run stops and is not marked as done.
+    """
+    if daemon.stop_requested():
+        log.info("Shutdown requested: run aborted, it will be restarted on next launch.")
+        return True
+    if deadline.run_expired():
+        log.info("RUN_TIMEOUT (%ss) reached: run aborted, it will be restarted on next launch.", RUN_TIMEOUT)
+        return True
+    reason = deadline.cut_short()
+    if reason:
+        log.info("Call refused (%s): run aborted, it will be restarted on next launch.", reason)
+        return True
+    return False
+
+def start_watcher():
+    """Starts watching LOCAL_DOWNLOAD_PATH, None when disabled or when the folder is not reachable from here."""
+    # a replayed run downloads nothing: waiting for files would only burn DOWNLOAD_WAIT_TIMEOUT
+    if replay.mode() == 'replay':
+        return None
+    if not WATCH_DOWNLOADS or not LOCAL_DOWNLOAD_PATH or not os.path.isdir(LOCAL_DOWNLOAD_PATH):
+        return None
+    return watcher.DownloadWatcher(LOCAL_DOWNLOAD_PATH)
+
+def scan_new_downloads(download_watcher, expected, settle):
+    """
+    Waits until the expected files have landed and stopped growing, then triggers exactly one scan.
+    The scan is skipped when nothing new arrived. Without watcher, scans right away (previous behaviour).
+    """
+    import subsonic
+    if expected == 0:
+        if download_watcher is not None:
+            download_watcher.close()
+        log.info("No download was triggered: scan skipped.")
+        return False
+    if download_watcher is not None:
+        timeout = DOWNLOAD_WAIT_TIMEOUT
+        left = deadline.remaining()
+        if left is not None:
+            timeout = max(0, min(timeout, left))
         try:
-            with open('data.json', 'r', encoding='utf-8') as f:
-                existing_data = json.load(f)
-
-                # Vérification si le nom de la playlist est identique
-                if existing_data.get('playlist_name') == playlist_name:
-                    print(f"Playlist '{playlist_name}' already exists (watch data.json).")
-                    print("Script shutdown.")
-                    return
-                try:
-                    os.rename('data.json', 'old_data.json')
-                    print("Old data.json moved as 'old_data.json'")
-                except Exception as e:
-                    print(f"Error when moving data.json : {e}")
-
-            if os.path.exists('old_data.json'):
-                try:
-                    with open('old_data.json', 'r', encoding='utf-8') as f:
-                        old_data = json.load(f)
-                        print(f"Loaded old data for cleanup: {old_data.get('playlist_name')}")
-                except Exception as e:
-                    print(f"Warning: Could not read old_data.json: {e}")
-
-        except json.JSONDecodeError:
-            print("data.json is empty or corrupted, we continue the script.")
-
-    print(f"New playlist detected: {playlist_name}. Processing...")
-
-    # get the songs list of the current playlist on listenbrainz with artist, title and album
-    lb_songs = lb.get_song_in_playlist(mbid, LB_BASE_URL)
-
-    already_local = [] #dict for local tracks that we don't want to process
-    full_tracks_ids = [] # dict for all the tracks detected ids
-    to_download_subsonic = [] # dict for download infos to give to subsonic
-    to_download_youtube = [] # dict for download infos to give to youtube
-    success_dl_subsonic = []
-    success_dl_youtube = []
-    not_found_tracks = [] # for tracks not found in subsonic or youtube
-
-    # --- STEP 1: SEARCH & MATCH ---
-    # Loop through ListenBrainz tracks and look for them on the Subsonic server
-    # 1. Check local library (isExternal: False)
-    # 2. Check Subsonic external sources (isExternal: True)
-    # 3. Fallback to YouTube if nothing is found
-
-    print("--- STEP 1 : SEARCH ---")
-    if not lb_songs:
-        print("No song in ListenBrainz Playlist")
+            new_files = download_watcher.wait(expected, timeout=timeout, settle=settle)
+        finally:
+            download_watcher.close()
+        if not new_files:
+            log.info("No new file landed in LOCAL_DOWNLOAD_PATH: scan skipped.")
+            return False
+        log.info("%s/%s new file(s) landed: starting scan.", len(new_files), expected)
+    subsonic.start_scan(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
+    return True
+
+def main(playlist_info=None):
+    """Runs the pipeline, one process at a time per STATE_DB (the others wait up to RUN_LOCK_WAIT seconds)."""
+    if replay.active():
+        # replayed run: works on an in-memory copy of STATE_DB, nothing shared to protect
+        run_pipeline(playlist_info)
         return
-    for song in lb_songs:
-        time.sleep(0.5)
-        artist = song['artist']
-        title = song['title']
-        album = song['album']
-        # get a dict with unique ID from the search of octo fiesta
-        tracks_dict = subsonic.search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, artist, title)
-        # find the only one with isexternal false + biggest similarity or isexternal true + biggest similarity
-        best_match = subsonic.compare_tracks(tracks_dict)
-        print("-"*30)
-        print(f"extracted from LB : {artist} - {title}")
-        print(f"Best match subsonic : {best_match}")
-        if best_match:
-            # 1. locally found
-            if best_match['isexternal'] == False:
-                print(f"Local found : {best_match['artist']} {best_match['title']} ; id = {best_match['download_id']}")
-                print("-"*30)
-                already_local.append(best_match)
-                full_tracks_ids.append(best_match['download_id'])
-            # 2. not locally found, to download with subsonic
-            else:
-                print(f"-> External found (queued for Subsonic DL)")
-                best_match['original_album'] = album
-                best_match['original_artist'] = artist
-                best_match['original_title'] = title
-                to_download_subsonic.append(best_match)
-                print(f"Added to download list {best_match['artist']} {best_match['title']} ; id = {best_match['download_id']}")
-                print("-"*30)
-        # 3. not found on subsonic -> queing for youtube or skip
-        else:
-            if YOUTUBE_FALLBACK:
-                print(f"-> Not found on Subsonic -> Queueing for YouTube")
-                to_download_youtube.append(song)
-            else:
-                print(f"-> Not found on Subsonic (YouTube fallback disabled, skipping)")
-                not_found_tracks.append(song)
-
-    # --- STEP 2: DOWNLOAD FROM SUBSONIC ---
-    # Trigger Subsonic/Octo-Fiesta downloads and scan library to update IDs
-
-    print("--- STEP 2 : DOWNLOAD FROM SUBSONIC ---")
-    if to_download_subsonic:
-        for item in to_download_subsonic:
-            time.sleep(3)
-            print(f"Triggering Subsonic DL for: {item['artist']} - {item['title']}")
-            subsonic.download_tracks(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, item['download_id'])
-
-        # trigger a scan on navidrome to get new ids
-        subsonic.start_scan(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
-
-        # verify if the subsonic downloaded file is available
-        print("Verify subsonic dl ---")
-        # to_download_subsonic contain track title from octo-fiesta, artist from octo-fiesta, similarity note with lb, download_id and isexternal value
-        for item in to_download_subsonic:
-            time.sleep(0.5)
-            search_newly_downloaded = subsonic.search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, item['artist'], item['title'])
-            # get if the newly downloaded track isexternal false or true
-            newly_downloaded_match = subsonic.compare_tracks(search_newly_downloaded)
-            if newly_downloaded_match and newly_downloaded_match['isexternal'] == False:
-                print(f"Success : {item['title']} is now local -> ID : {newly_downloaded_match['download_id']}")
-                success_dl_subsonic.append(newly_downloaded_match['download_id'])
-                full_tracks_ids.append(newly_downloaded_match['download_id'])
+    with coordinator.RunLock(STATE_DB + ".lock", RUN_LOCK_WAIT) as locked:
+        if not locked:
+            log.info("Another run still holds %s.lock after %ss: script shutdown.", STATE_DB, RUN_LOCK_WAIT)
+            return
+        # the playlist check happens under the lock: a run that was waiting finds the playlist processed
+        run_pipeline(playlist_info)
+
+def run_pipeline(playlist_info=None):
+    with profiling.stage("init"):
+        # --- STEP 0: INITIALIZATION & CHECK ---
+        # Fetch playlist info from ListenBrainz and check if we already processed it
+        if playlist_info is None:
+            playlist_info = lb.get_weekly_playlist_infos(LB_BASE_URL, LB_USER)
+        if not playlist_info:
+            log.error("CRITICAL: Can't get playlist info from ListenBrainz")
+            return
+
+        playlist_name = playlist_info["name"]
+        mbid = playlist_info["mbid"]
+
+        state.configure(STATE_DB, scratch=replay.active())
+        # Vérification si la playlist a déjà été traitée
+        if state.is_processed(playlist_name):
+            log.info("Playlist '%s' already exists (watch %s).", playlist_name, STATE_DB)
+            log.info("Script shutdown.")
+            return
+        # a run is only marked as done at the very end, an interrupted run is simply redone on next launch
+        old_run = state.last_run()
+        if old_run:
+            log.info("Loaded previous run for cleanup: %s", old_run['playlist_name'])
+
+        log.info("New playlist detected: %s. Processing...", playlist_name)
+        deadline.start_run()
+        import subsonic
+        run_id = state.start_run(playlist_name, mbid)
+
+        # get the songs list of the current playlist on listenbrainz with artist, title and album
+        lb_songs = lb.get_song_in_playlist(mbid, LB_BASE_URL)
+
+        already_local = [] # Candidates of local tracks that we don't want to process
+        full_tracks_ids = [] # ids of all the tracks of the new playlist
+        to_download_subsonic = [] # external Candidates to download through subsonic
+        to_download_youtube = [] # Tracks to search and download on youtube
+        success_dl_subsonic = []
+        success_dl_youtube = []
+        not_found_tracks = [] # Tracks not found in subsonic or youtube
+        speculative = None # background YouTube searches (SPECULATIVE_YOUTUBE)
+        carried_over = [] # Tracks already resolved by the previous run, reused as is
+        old_playlist_id = None # previous weekly playlist, kept to be updated in place (WEEKLY_DIFF)
+
+    with profiling.stage("search"), deadline.stage("search"):
+        # --- STEP 1: SEARCH & MATCH ---
+        # Loop through ListenBrainz tracks and look for them on the Subsonic server
+        # 1. Check local library (isExternal: False)
+        # 2. Check Subsonic external sources (isExternal: True)
+        # 3. Fallback to YouTube if nothing is found
+
+        log.info("--- STEP 1 : SEARCH ---")
+        if not lb_songs:
+            log.info("No song in ListenBrainz Playlist")
+            return
+        # --- DIFF with the previous run: tracks still there are reused without searching ---
+        previous = state.resolved_tracks(old_run['id']) if old_run and WEEKLY_DIFF else {}
+        # --- MBID lookup: recording id -> local song id, no search at all ---
+        mbid_index = {}
+        if MBID_MATCHING:
+            age = state.mbid_index_age() if MBID_LIBRARY_INDEX else None
+            if MBID_LIBRARY_INDEX and (age is None or age > MBID_INDEX_MAX_AGE * 86400):
+                built = subsonic.build_mbid_index(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
+                if built:
+                    state.save_mbid_index(*built)
+            mbid_index = state.mbid_song_ids()
+        # carried-over and MBID-matched songs may have been removed since (by the user, Octo-Fiesta expiry):
+        # those are searched again
+        reused_ids = [previous[s.key]['song_id'] for s in lb_songs if s.key in previous]
+        reused_ids += [mbid_index[s.mbid] for s in lb_songs if s.mbid in mbid_index]
+        if reused_ids:
+            gone = subsonic.missing_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, reused_ids)
+            if gone:
+                previous = {key: r for key, r in previous.items() if r['song_id'] not in gone}
+                mbid_index = {mbid: song_id for mbid, song_id in mbid_index.items() if song_id not in gone}
+                state.mark_deleted(gone)
+                subsonic.forget_songs(gone)
+        if SEARCH_BATCHING:
+            subsonic.prefetch_searches(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS,
+                                       [s for s in lb_songs if s.key not in previous and s.mbid not in mbid_index])
+        for song in lb_songs:
+            if interrupted():
+                return
+            reused = previous.get(song.key)
+            if reused:
+                log.info("Carried over from last week: %s - %s ; id = %s", song.artist, song.title, reused['song_id'])
+                carried_over.append(song)
+                full_tracks_ids.append(reused['song_id'])
+                state.record_resolution(run_id, song, reused['song_id'], reused['source'], reused['similarity'])
+                continue
+            song_id = mbid_index.get(song.mbid) if song.mbid else None
+            if song_id:
+                log.info("MBID match : %s - %s ; id = %s", song.artist, song.title, song_id)
+                already_local.append(Candidate(song_id, song.artist, song.title, 1.0, track=song))
+                full_tracks_ids.append(song_id)
+                state.record_resolution(run_id, song, song_id, 'local', 1.0)
+                continue
+            # get the Candidates (unique ids) from the search of octo fiesta
+            candidates = subsonic.search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, song.artist, song.title, song.duration)
+            if interrupted():
+                # a refused search says nothing about the track: not classified
+                return
+            # find the only one with external false + biggest similarity or external true + biggest similarity
+            best_match = subsonic.compare_tracks(candidates)
+            log.debug("-"*30)
+            log.info("extracted from LB : %s - %s", song.artist, song.title)
+            log.debug("Best match subsonic : %s", best_match)
+            if best_match:
+                best_match.track = song
+                # 1. locally found
+                if not best_match.external:
+                    log.info("Local found : %s %s ; id = %s", best_match.artist, best_match.title, best_match.id)
+                    already_local.append(best_match)
+                    full_tracks_ids.append(best_match.id)
+                    state.record_resolution(run_id, song, best_match.id, 'local', best_match.similarity)
+                    if MBID_MATCHING and song.mbid and best_match.similarity >= 0.9:
+                        state.remember_mbid(song.mbid, best_match.id)
+                # 2. not locally found, to download with subsonic
+                else:
+                    log.info("-> External found (queued for Subsonic DL)")
+                    to_download_subsonic.append(best_match)
+                    log.info("Added to download list %s %s ; id = %s", best_match.artist, best_match.title, best_match.id)
+            # 3. not found on subsonic -> queing for youtube or skip
             else:
                 if YOUTUBE_FALLBACK:
-                    print(f"Failure: {item['title']} download failed via Subsonic. Moving to YouTube fallback.")
-                    song_fallback = {
-                            'artist': item['original_artist'],
-                            'title': item['original_title'],
-                            'album': item.get('original_album', 'Unknown Album')
-                        }
-                    to_download_youtube.append(song_fallback)
+                    log.info("-> Not found on Subsonic -> Queueing for YouTube")
+                    to_download_youtube.append(song)
                 else:
-                    print(f"Failure: {item['title']} download failed via Subsonic (YouTube fallback disabled, skipping)")
-                    not_found_tracks.append({
-                        'artist': item['original_artist'],
-                        'title': item['original_title'],
-                        'album': item.get('original_album', 'Unknown Album')
-                    })
-
-    # --- STEP 3: YOUTUBE FALLBACK ---
-    # For tracks not found on Subsonic, search and download from YouTube
-
-    print("--- STEP 3 : PROCESS YT FALLBACKS ---")
-    if not YOUTUBE_FALLBACK:
-        if to_download_youtube:
-            print(f"YouTube fallback is disabled. {len(to_download_youtube)} track(s) skipped.")
-            not_found_tracks.extend(to_download_youtube)
-            to_download_youtube.clear()
-        else:
-            print("YouTube fallback is disabled. No tracks to skip.")
-    # to_download_youtube contain track title, artist and album
-    if to_download_youtube:
-        attempted_downloads = []
-        for track in to_download_youtube:
-            time.sleep(0.5)
-            yt_track_data = youtube.search_yt(track['artist'], track['title'], limit=10)
-            if yt_track_data: # trigger download
-                print(f"Triggering Download of: {yt_track_data['original_title']}")
-                success = youtube.download_yt(yt_track_data, LOCAL_DOWNLOAD_PATH)
-                if success:
-                    attempted_downloads.append(track)
+                    log.info("-> Not found on Subsonic (YouTube fallback disabled, skipping)")
+                    not_found_tracks.append(song)
+                    state.record_resolution(run_id, song, None, 'not_found')
+
+    with profiling.stage("subsonic_download"), deadline.stage("subsonic_download"):
+        # --- STEP 2: DOWNLOAD FROM SUBSONIC ---
+        # Trigger Subsonic/Octo-Fiesta downloads and scan library to update IDs
+
+        log.info("--- STEP 2 : DOWNLOAD FROM SUBSONIC ---")
+        if to_download_subsonic:
+            # watch the library folder before triggering so no file is missed
+            download_watcher = start_watcher()
+            if SPECULATIVE_YOUTUBE and YOUTUBE_FALLBACK:
+                import youtube
+                speculative = youtube.SpeculativeSearch(SPECULATIVE_WORKERS, limit=10)
+            triggered = 0 # files expected to land (failed or refused triggers download nothing)
+            for item in to_download_subsonic:
+                if interrupted():
+                    if download_watcher:
+                        download_watcher.close()
+                    if speculative:
+                        speculative.close()
+                    return
+                log.info("Triggering Subsonic DL for: %s - %s", item.artist, item.title)
+                if subsonic.download_tracks(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, item.id):
+                    triggered += 1
+                if speculative:
+                    speculative.submit(item.track)
+
+            # trigger a scan on navidrome to get new ids, once the files are really there
+            scan_new_downloads(download_watcher, triggered, DOWNLOAD_SETTLE)
+
+            # verify if the subsonic downloaded file is available
+            log.info("Verify subsonic dl ---")
+            # to_download_subsonic contain Candidates with title/artist from octo-fiesta and the ListenBrainz Track they match
+            for item in to_download_subsonic:
+                if interrupted():
+                    if speculative:
+                        speculative.close()
+                    return
+                search_newly_downloaded = subsonic.search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, item.artist, item.title,
+                                                               item.track.duration)
+                if interrupted():
+                    if speculative:
+                        speculative.close()
+                    return
+                # get if the newly downloaded track is external or not
+                newly_downloaded_match = subsonic.compare_tracks(search_newly_downloaded)
+                original_song = item.track
+                if newly_downloaded_match and not newly_downloaded_match.external:
+                    log.info("Success : %s is now local -> ID : %s", item.title, newly_downloaded_match.id)
+                    success_dl_subsonic.append(newly_downloaded_match.id)
+                    full_tracks_ids.append(newly_downloaded_match.id)
+                    state.record_download(run_id, newly_downloaded_match.id, 'subsonic')
+                    state.record_resolution(run_id, original_song, newly_downloaded_match.id, 'subsonic', newly_downloaded_match.similarity)
+                    if MBID_MATCHING and original_song.mbid:
+                        state.remember_mbid(original_song.mbid, newly_downloaded_match.id)
+                    if speculative:
+                        speculative.discard(original_song)
                 else:
-                    not_found_tracks.append(track) # Echec DL malgré search ok
+                    if YOUTUBE_FALLBACK:
+                        log.warning("Failure: %s download failed via Subsonic. Moving to YouTube fallback.", item.title)
+                        to_download_youtube.append(original_song)
+                    else:
+                        log.warning("Failure: %s download failed via Subsonic (YouTube fallback disabled, skipping)", item.title)
+                        not_found_tracks.append(original_song)
+                        state.record_resolution(run_id, original_song, None, 'not_found')
+
+    with profiling.stage("youtube_fallback"), deadline.stage("youtube_fallback"):
+        # --- STEP 3: YOUTUBE FALLBACK ---
+        # For tracks not found on Subsonic, search and download from YouTube
+
+        log.info("--- STEP 3 : PROCESS YT FALLBACKS ---")
+        if not YOUTUBE_FALLBACK:
+            if to_download_youtube:
+                log.info("YouTube fallback is disabled. %s track(s) skipped.", len(to_download_youtube))
+                not_found_tracks.extend(to_download_youtube)
+                for track in to_download_youtube:
+                    state.record_resolution(run_id, track, None, 'not_found')
+                to_download_youtube.clear()
             else:
-                print(f"YT Search failed for {track['artist']} - {track['title']}")
-                not_found_tracks.append(track) # Echec Search
-        if attempted_downloads:
-            print("Verify youtube dl ---")
-
-    # --- STEP 4: SCAN & VERIFICATION ---
-    # Final scan to ensure all new downloads are indexed and assigned internal IDs
-
-            # trigger a scan on navidrome to get ids
-            subsonic.start_scan(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
-
-            # to_download_youtube contain track title from LB and artist from LB, album
-            for item in attempted_downloads:
-                time.sleep(0.5)
-                search_newly_downloaded = subsonic.search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, item['artist'], item['title'])
-                # get if the newly downloaded track isexternal false or true
-                newly_downloaded_match = subsonic.compare_tracks(search_newly_downloaded)
-                if newly_downloaded_match and newly_downloaded_match['isexternal'] == False:
-                    print(f"Success YT : {item['title']} is now local -> ID : {newly_downloaded_match['download_id']}")
-                    success_dl_youtube.append(newly_downloaded_match['download_id'])
-                    full_tracks_ids.append(newly_downloaded_match['download_id'])
+                log.info("YouTube fallback is disabled. No tracks to skip.")
+        # to_download_youtube contain ListenBrainz Tracks
+        if to_download_youtube:
+            import youtube
+            download_watcher = start_watcher()
+            attempted_downloads = []
+            for track in to_download_youtube:
+                if interrupted():
+                    if download_watcher:
+                        download_watcher.close()
+                    if speculative:
+                        speculative.close()
+                    return
+                # speculative mode: the search was started while the Octo-Fiesta download was pending
+                yt_track_data = speculative.result(track) if speculative else youtube.search_yt(track, limit=10)
+                if yt_track_data: # trigger download
+                    log.info("Triggering Download of: %s", yt_track_data.original_title)
+                    success = youtube.download_yt(yt_track_data, LOCAL_DOWNLOAD_PATH, timeout=YT_DOWNLOAD_TIMEOUT)
+                    if not success and interrupted():
+                        if download_watcher:
+                            download_watcher.close()
+                        if speculative:
+                            speculative.close()
+                        return
+                    if success:
+                        attempted_downloads.append(track)
+                    else:
+                        not_found_tracks.append(track) # Echec DL malgré search ok
+                        state.record_resolution(run_id, track, None, 'not_found')
+                elif interrupted():
+                    if download_watcher:
+                        download_watcher.close()
+                    if speculative:
+                        speculative.close()
+                    return
                 else:
-                    print(f"Warning: {item['title']} downloaded but not found in Subsonic scan yet.")
-                    not_found_tracks.append(item)
-
-    # --- STEP 5: CLEANUP ---
-    # Delete the previous week's playlist from the server
-    # Physically delete files that are no longer needed (not starred, not in other playlists)
-
-    print("--- STEP 5 : CLEANUP (Old Playlist & Files) ---")
-    if old_data:
-        old_name = old_data.get("playlist_name")
-
-        if old_name:
-            all_playlists = subsonic.get_all_playlists(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
-            old_playlist_id = next((p['id'] for p in all_playlists if p['name'] == old_name), None)
-
-            if old_playlist_id:
-                print(f"Deleting old playlist '{old_name}' (ID: {old_playlist_id})...")
-                subsonic.delete_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, old_playlist_id)
-                time.sleep(2)
+                    log.warning("YT Search failed for %s - %s", track.artist, track.title)
+                    not_found_tracks.append(track) # Echec Search
+                    state.record_resolution(run_id, track, None, 'not_found')
+            if not attempted_downloads and download_watcher:
+                download_watcher.close()
+            if attempted_downloads:
+                log.info("Verify youtube dl ---")
+
+        # --- STEP 4: SCAN & VERIFICATION ---
+        # Final scan to ensure all new downloads are indexed and assigned internal IDs
+
+                # trigger a scan on navidrome to get ids (yt-dlp is synchronous: files are already complete)
+                scan_new_downloads(download_watcher, len(attempted_downloads), settle=min(2, DOWNLOAD_SETTLE))
+
+                # attempted_downloads contain the ListenBrainz Tracks (files are named after them)
+                for item in attempted_downloads:
+                    if interrupted():
+                        return
+                    search_newly_downloaded = subsonic.search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, item.artist, item.title,
+                                                                   item.duration)
+                    if interrupted():
+                        if speculative:
+                            speculative.close()
+                        return
+                    # get if the newly downloaded track is external or not
+                    newly_downloaded_match = subsonic.compare_tracks(search_newly_downloaded)
+                    if newly_downloaded_match and not newly_downloaded_match.external:
+                        log.info("Success YT : %s is now local -> ID : %s", item.title, newly_downloaded_match.id)
+                        success_dl_youtube.append(newly_downloaded_match.id)
+                        full_tracks_ids.append(newly_downloaded_match.id)
+                        state.record_download(run_id, newly_downloaded_match.id, 'youtube')
+                        state.record_resolution(run_id, item, newly_downloaded_match.id, 'youtube', newly_downloaded_match.similarity)
+                        if MBID_MATCHING and item.mbid:
+                            state.remember_mbid(item.mbid, newly_downloaded_match.id)
+                    else:
+                        log.warning("Warning: %s downloaded but not found in Subsonic scan yet.", item.title)
+                        not_found_tracks.append(item)
+                        state.record_resolution(run_id, item, None, 'not_found')
+        if speculative:
+            speculative.close()
+
+    with profiling.stage("cleanup"), deadline.stage("cleanup"):
+        # --- STEP 5: CLEANUP ---
+        # Delete the previous week's playlist from the server (kept for an in-place update with WEEKLY_DIFF)
+        # Physically delete files that are no longer needed (not starred, not in other playlists, not in the new playlist)
+
+        if interrupted():
+            return
+        log.info("--- STEP 5 : CLEANUP (Old Playlist & Files) ---")
+        if old_run:
+            old_name = old_run["playlist_name"]
+
+            if old_name:
+                all_playlists = subsonic.get_all_playlists(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
+                old_playlist_id = next((p['id'] for p in all_playlists if p['name'] == old_name), None)
+
+                if old_playlist_id and WEEKLY_DIFF:
+                    log.info("Old playlist '%s' (ID: %s) kept, it will be updated in place.", old_name, old_playlist_id)
+                elif old_playlist_id:
+                    log.info("Deleting old playlist '%s' (ID: %s)...", old_name, old_playlist_id)
+                    subsonic.delete_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, old_playlist_id)
+                    old_playlist_id = None
+                else:
+                    log.info("Old playlist '%s' not found on server (already deleted?).", old_name)
+
+            if CLEANUP_DOWNLOADS:
+                # files downloaded by the script for the previous playlist and still on disk,
+                # minus the ones that are part of this week's playlist too
+                keep_ids = set(full_tracks_ids)
+                if DISCOVERY_CACHE_MAX_MB > 0:
+                    # cache mode: every download of every run is kept while the budget allows, least recently played go first
+                    to_delete_ids = subsonic.flag_for_eviction(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, LOCAL_DOWNLOAD_PATH,
+                                                               state.live_downloads(), keep_ids, DISCOVERY_CACHE_MAX_MB * 2**20)
+                else:
+                    candidate_ids = [i for i in state.cleanup_candidates(old_run['id']) if i not in keep_ids]
+                    to_delete_ids = subsonic.flag_for_cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, candidate_ids)
+
+                if to_delete_ids:
+                    log.info("Starting cleanup of %s obsolete tracks...", len(to_delete_ids))
+                    deleted_ids = subsonic.cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, LOCAL_DOWNLOAD_PATH, to_delete_ids)
+                    state.mark_deleted(deleted_ids)
+                    log.info("Cleanup finished. %s files removed.", len(deleted_ids))
+                else:
+                    log.info("Nothing to clean up.")
             else:
-                print(f"Old playlist '{old_name}' not found on server (already deleted?).")
-
-        if CLEANUP_DOWNLOADS:
-            to_delete_ids = subsonic.flag_for_cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, old_data)
+                log.info("CLEANUP_DOWNLOADS is disabled. Skipping file cleanup.")
 
-            if to_delete_ids:
-                print(f"Starting cleanup of {len(to_delete_ids)} obsolete tracks...")
-                deleted_count = subsonic.cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, LOCAL_DOWNLOAD_PATH, to_delete_ids)
-                print(f"Cleanup finished. {deleted_count} files removed.")
-            else:
-                print("Nothing to clean up.")
         else:
-            print("CLEANUP_DOWNLOADS is disabled. Skipping file cleanup.")
-
-    else:
-        print("No old_data.json found. Skipping cleanup.")
-
-    # --- STEP 6: PLAYLIST CREATION ---
-    # Create the new Weekly Discovery playlist on the server and update data.json
-
-    print("--- STEP 6 : CREATE PLAYLIST and data.json ---")
-    data_to_save = {
-        "playlist_name": playlist_name,
-        "subsonic_downloaded": success_dl_subsonic,
-        "youtube_downloaded": success_dl_youtube,
-        "all_tracks_ids": full_tracks_ids,
-        "not_found": not_found_tracks,
-        "already_local": already_local
-    }
-
-    if full_tracks_ids:
-        subsonic.create_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_name, list(full_tracks_ids))
-    else:
-        print("No new tracks to add to a playlist (only local tracks found ?).")
+            log.info("No previous run found in the state database. Skipping cleanup.")
+
+    with profiling.stage("playlist"), deadline.stage("playlist"):
+        # --- STEP 6: PLAYLIST CREATION ---
+        # Create the new Weekly Discovery playlist on the server and mark the run as done
+
+        if interrupted():
+            return
+        log.info("--- STEP 6 : CREATE PLAYLIST and save state ---")
+        updated = False
+        if old_playlist_id and full_tracks_ids:
+            updated = subsonic.update_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, old_playlist_id, playlist_name,
+                                               list(full_tracks_ids), chunk_size=PLAYLIST_CHUNK_SIZE)
+        if old_playlist_id and not updated:
+            # nothing to put in it, or the in-place update failed: rebuild from scratch
+            subsonic.delete_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, old_playlist_id)
+        if full_tracks_ids and not updated:
+            created = subsonic.create_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_name, list(full_tracks_ids),
+                                               chunk_size=PLAYLIST_CHUNK_SIZE)
+            if not created:
+                # not marked done: the next run (or daemon poll) builds the playlist again
+                log.warning("Playlist '%s' could not be created: run not marked as done.", playlist_name)
+                return
+        elif not full_tracks_ids:
+            log.info("No new tracks to add to a playlist (only local tracks found ?).")
+        if interrupted():
+            return
+
+        state.finish_run(run_id, full_tracks_ids)
+        log.info("Run saved: %s tracks, %s carried over, %s downloaded via Subsonic, %s via YouTube, %s already local, %s not found.",
+                 len(full_tracks_ids), len(carried_over), len(success_dl_subsonic), len(success_dl_youtube), len(already_local),
+                 len(not_found_tracks))
+        if hedge.stats['hedged']:
+            log.info("Hedged requests: %s duplicate(s) for %s call(s), %s answered first.",
+                     hedge.stats['hedged'], hedge.stats['calls'], hedge.stats['hedge_won'])
+        if replay.mode():
+            log.info("HTTP %s", replay.summary())
+
+def poll_new_playlist():
+    """Daemon poll: returns the ListenBrainz playlist info only if it was not processed yet."""
+    playlist_info = lb.get_weekly_playlist_infos(LB_BASE_URL, LB_USER)
+    if not playlist_info:
+        return None
+    if state.is_processed(playlist_info['name']):
+        return None
+    return playlist_info
 
-    with open('data.json', 'w', encoding='utf-8') as f:
-        json.dump(data_to_save, f, ensure_ascii=False, indent=4)
+def sync(playlist_info):
+    profiling.configure(PROFILE, PROFILE_DIR)
+    try:
+        main(playlist_info)
+    finally:
+        deadline.stop_run()
 
 
 if __name__ == "__main__":
-    main()
+    logs.setup(LOG_LEVEL, LOG_JSON)
+    state.configure(STATE_DB, scratch=replay.active())
+    if DAEMON_MODE:
+        daemon.run(poll_new_playlist, sync, POLL_INTERVAL, POLL_JITTER)
+    else:
+        profiling.configure(PROFILE, PROFILE_DIR)
+        main()
@@ -0,0 +1,49 @@
+from dataclasses import dataclass
+
+# Records passed between lb, subsonic, youtube, main and state.
+# slots=True: no per-instance __dict__, a few hundred bytes less per record on big playlists / library indexes.
+
+@dataclass(slots=True)
+class Track:
+    """A ListenBrainz playlist entry: what we are looking for."""
+    artist: str
+    title: str
+    album: str = ''
+    duration: int = None # seconds, None when ListenBrainz does not know it
+    mbid: str = None     # MusicBrainz recording id
+    artist_mbids: tuple = () # MusicBrainz artist ids (artist credit order)
+
+    @property
+    def key(self):
+        return (self.artist, self.title)
+
+    def as_row(self):
+        """Column values of the state database `tracks` table."""
+        return (self.artist, self.title, self.album or '')
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a Track from the old dict format (data.json)."""
+        return cls(data['artist'], data['title'], data.get('album') or '')
+
+
+@dataclass(slots=True)
+class Candidate:
+    """
+    A song found for a Track: a Subsonic song (local, or external through Octo-Fiesta)
+    or a YouTube video, with its similarity score.
+    """
+    id: str                  # Subsonic song id / YouTube video id
+    artist: str
+    title: str
+    similarity: float
+    external: bool = False   # Subsonic only: not in the library yet (Octo-Fiesta)
+    source: str = 'subsonic' # subsonic / youtube
+    track: Track = None      # the ListenBrainz track it was matched for
+    original_title: str = '' # YouTube only: raw video title
+
+    @property
+    def url(self):
+        if self.source == 'youtube':
+            return f"https://www.youtube.com/watch?v={self.id}"
+        return None
@@ -0,0 +1,85 @@
+import os
+import io
+import time
+from contextlib import contextmanager
+import logging
+
+log = logging.getLogger(__name__)
+
+# Stage reports are written under PROFILE_DIR/<run timestamp>/
+_enabled = False
+_run_dir = None
+_stage_counter = 0
+
+def configure(enabled, base_dir="profiles"):
+    """Enables or disables per-stage profiling for the current process."""
+    global _enabled, _run_dir, _stage_counter
+    _enabled = enabled
+    _stage_counter = 0
+    _run_dir = None
+    if enabled:
+        _run_dir = os.path.join(base_dir, time.strftime("%Y%m%d-%H%M%S"))
+        os.makedirs(_run_dir, exist_ok=True)
+        log.info("Profiling enabled, reports written to: %s", _run_dir)
+
+def _write_reports(name, profiler, snapshot, elapsed):
+    """Dumps the cProfile stats and the tracemalloc top allocations of one stage."""
+    import pstats
+    import tracemalloc
+
+    base = os.path.join(_run_dir, f"{_stage_counter:02d}_{name}")
+
+    # Raw stats, can be opened later with snakeviz / pstats
+    profiler.dump_stats(base + ".prof")
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stream.write(f"Stage '{name}' wall time: {elapsed:.3f}s\n\n")
+    stats.sort_stats("cumulative").print_stats(40)
+    stats.sort_stats("tottime").print_stats(25)
+    with open(base + ".cpu.txt", 'w', encoding='utf-8') as f:
+        f.write(stream.getvalue())
+
+    # Ignore allocations made by the profilers themselves
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    with open(base + ".mem.txt", 'w', encoding='utf-8') as f:
+        f.write(f"Stage '{name}' traced memory: current={current / 1024:.1f} KiB, peak={peak / 1024:.1f} KiB\n\n")
+        for stat in snapshot.statistics('lineno')[:30]:
+            f.write(f"{stat}\n")
+
+@contextmanager
+def stage(name):
+    """
+    Runs the enclosed block under cProfile and tracemalloc and writes one report per stage.
+    Costs nothing when profiling is disabled.
+    """
+    global _stage_counter
+    if not _enabled:
+        yield
+        return
+
+    import cProfile
+    import tracemalloc
+
+    _stage_counter += 1
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        try:
+            _write_reports(name, profiler, snapshot, elapsed)
+        except Exception as e:
+            log.warning("Warning: could not write profiling report for '%s': %s", name, e)
+        tracemalloc.stop()
+        log.info("[Profile] %s: %.2fs", name, elapsed)
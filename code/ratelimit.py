@@ -0,0 +1,124 @@
+import threading
+import time
+
+# One token bucket per upstream, shared by every module (and every thread).
+# The rate adapts to the server feedback (AIMD):
+#  - 429 / 503 / timeouts or latency far above the usual one -> rate divided
+#  - fast successful answers -> rate slowly increased up to max_rate
+#  - Retry-After -> the whole upstream is paused for the requested time
+
+class TokenBucket:
+    def __init__(self, name, rate, burst=1, min_rate=None, max_rate=None):
+        self.name = name
+        self.rate = float(rate)            # tokens (requests) per second
+        self.burst = max(1.0, float(burst))
+        self.min_rate = float(min_rate) if min_rate else self.rate / 10
+        self.max_rate = float(max_rate) if max_rate else self.rate * 4
+        self.tokens = self.burst
+        self.blocked_until = 0.0
+        self.latency_avg = None            # EWMA of successful answers latency
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Blocks until a request is allowed on this upstream. Returns the time waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def _slow_down(self, factor):
+        self.rate = max(self.min_rate, self.rate * factor)
+        self.tokens = min(self.tokens, 1.0)
+
+    def feedback(self, status=None, latency=None, retry_after=None, error=False):
+        """
+        Adjusts the rate from the outcome of a request.
+        status: HTTP status code (None if no answer), latency: seconds, retry_after: seconds, error: network failure.
+        """
+        with self._lock:
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            if status in (429, 503) or error:
+                self._slow_down(0.5)
+                return
+            if latency is None:
+                return
+            if self.latency_avg is None:
+                self.latency_avg = latency
+                return
+            if latency > 3 * self.latency_avg and latency > 0.5:
+                # server is struggling: back off before it starts failing
+                self._slow_down(0.8)
+            elif latency <= 1.5 * self.latency_avg:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            self.latency_avg = 0.8 * self.latency_avg + 0.2 * latency
+
+
+_buckets = {}
+_registry_lock = threading.Lock()
+_enabled = True
+
+# name: (requests per second, burst)
+DEFAULTS = {
+    'subsonic': (10, 5),
+    'octo_trigger': (0.5, 1),
+    'listenbrainz': (2, 2),
+    'youtube': (1, 2),
+}
+
+def configure(name, rate, burst=1, min_rate=None, max_rate=None):
+    """(Re)creates the bucket of an upstream."""
+    with _registry_lock:
+        _buckets[name] = TokenBucket(name, rate, burst, min_rate, max_rate)
+        return _buckets[name]
+
+def get(name):
+    with _registry_lock:
+        bucket = _buckets.get(name)
+        if bucket is None:
+            rate, burst = DEFAULTS.get(name, (1, 1))
+            bucket = _buckets[name] = TokenBucket(name, rate, burst)
+        return bucket
+
+def set_enabled(enabled):
+    """False: no wait at all (replayed runs, where nothing reaches the upstreams)."""
+    global _enabled
+    _enabled = enabled
+
+def acquire(name):
+    if not _enabled:
+        return 0.0
+    return get(name).acquire()
+
+def feedback(name, status=None, latency=None, retry_after=None, error=False):
+    if not _enabled:
+        return
+    get(name).feedback(status=status, latency=latency, retry_after=retry_after, error=error)
+
+def parse_retry_after(value):
+    """Converts a Retry-After header (seconds or HTTP date) to seconds, None if absent/invalid."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,348 @@
+import atexit
+import base64
+import gzip
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+from email.message import Message
+import logging
+
+log = logging.getLogger(__name__)
+
+# HTTP record / replay fixtures for offline regression runs.
+#   HTTP_RECORD=week.jsonl.gz  captures every outbound call (Subsonic via requests, ListenBrainz via urllib,
+#                              yt-dlp flat searches and download outcomes) of a real run.
+#   HTTP_REPLAY=week.jsonl.gz  serves them back without network, in recorded order per request
+#                              (the last answer is repeated once a request runs out of recorded answers).
+# Credentials (u, p, t, s) are never written and are ignored when matching requests.
+
+AUTH_PARAMS = {'u', 'p', 't', 's'}
+KEPT_HEADERS = ('Content-Type', 'Retry-After')
+YT_ENTRY_KEYS = ('id', 'title', 'uploader', 'channel', 'duration', 'url')
+
+_mode = None          # None / 'record' / 'replay'
+_path = None
+_timing = False       # replay: sleep the recorded latency of each call
+_lock = threading.Lock()
+_out = None           # record: open fixture file
+_answers = {}         # replay: key -> deque of recorded entries
+_served = {}          # call kind -> calls served (or recorded)
+_missing = {}         # replay: key -> calls not found in the fixture
+
+def configure(record=None, replay=None, timing=False):
+    """Enables record mode (record=path) or replay mode (replay=path). Both empty: normal network calls."""
+    global _mode, _path, _timing, _out
+    close()
+    _timing = timing
+    _answers.clear()
+    _served.clear()
+    _missing.clear()
+    if replay:
+        _mode, _path = 'replay', replay
+        count = 0
+        with _open(replay, 'rt') as f:
+            for line in f:
+                entry = json.loads(line)
+                if 'key' in entry:
+                    _answers.setdefault(entry['key'], deque()).append(entry)
+                    count += 1
+        log.info("Replaying %s recorded call(s) from %s (timing %s).", count, replay, "on" if timing else "off")
+    elif record:
+        _mode, _path = 'record', record
+        _out = _open(record, 'wt')
+        # gzip needs its trailer: closed at exit even when the run is interrupted
+        atexit.register(close)
+        _out.write(json.dumps({'version': 1, 'recorded_at': time.time()}) + "\n")
+        log.info("Recording every outbound call to %s.", record)
+    else:
+        _mode, _path = None, None
+
+def mode():
+    return _mode
+
+def active():
+    """True in a replayed run: nothing may touch the disk, the state database or the network."""
+    return _mode == 'replay'
+
+def sleep(seconds):
+    """time.sleep(), skipped in a replayed run (the recorded latencies, HTTP_REPLAY_TIMING, are the only waits)."""
+    if _mode != 'replay':
+        time.sleep(seconds)
+
+def close():
+    global _out
+    with _lock:
+        if _out is not None:
+            _out.close()
+            _out = None
+
+def _open(path, how):
+    if path.endswith('.gz'):
+        return gzip.open(path, how, encoding='utf-8')
+    return open(path, how, encoding='utf-8')
+
+def request_key(method, url, body=None):
+    """'GET /rest/search3?query=...' with sorted parameters, without host and credentials."""
+    parsed = urllib.parse.urlsplit(url)
+    params = urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+    if body:
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        params += urllib.parse.parse_qsl(body, keep_blank_values=True)
+    params = sorted((k, v) for k, v in params if k not in AUTH_PARAMS)
+    query = urllib.parse.urlencode(params)
+    return f"{method} {parsed.path}" + (f"?{query}" if query else "")
+
+def _count(key):
+    # 'GET /rest/search3', 'YTSEARCH', 'YTDL'
+    kind = key.split('?', 1)[0] if key.startswith(('GET ', 'POST ')) else key.split(' ', 1)[0]
+    _served[kind] = _served.get(kind, 0) + 1
+
+def _record(entry):
+    with _lock:
+        _count(entry['key'])
+        if _out is not None:
+            _out.write(json.dumps(entry, separators=(',', ':'), ensure_ascii=False) + "\n")
+            _out.flush()
+
+def _answer(key):
+    """Next recorded entry for this key (None if the fixture never saw it)."""
+    with _lock:
+        answers = _answers.get(key)
+        if not answers:
+            _missing[key] = _missing.get(key, 0) + 1
+            return None
+        entry = answers.popleft() if len(answers) > 1 else answers[0]
+        _count(key)
+    if _timing and entry.get('elapsed'):
+        time.sleep(entry['elapsed'])
+    return entry
+
+def _encode_body(content):
+    if content is None:
+        return {}
+    try:
+        return {'body': content.decode('utf-8')}
+    except UnicodeDecodeError:
+        # binary payload (audio stream): only the size matters to the script
+        return {'body_b64': base64.b64encode(content[:1024]).decode('ascii'), 'size': len(content)}
+
+def _decode_body(entry):
+    if 'body' in entry:
+        return entry['body'].encode('utf-8')
+    if 'body_b64' in entry:
+        return base64.b64decode(entry['body_b64'])
+    return b''
+
+def summary():
+    """One line describing what was recorded or replayed (None in normal mode)."""
+    if _mode is None:
+        return None
+    with _lock:
+        served = ", ".join(f"{k}={v}" for k, v in sorted(_served.items()))
+        missing = sum(_missing.values())
+    text = f"{_mode}: {served or 'no call'}"
+    if _mode == 'replay' and missing:
+        text += f" ; {missing} call(s) not in the fixture: " + ", ".join(sorted(_missing)[:5])
+    return text
+
+# --- requests (Subsonic) ---
+
+def mount(session):
+    """Plugs the record or replay adapter into a requests session."""
+    if _mode is None:
+        return session
+    adapter = _RecordAdapter() if _mode == 'record' else _ReplayAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class _RecordAdapter:
+    """Built lazily on top of requests' HTTPAdapter (requests stays a lazy import)."""
+    def __new__(cls):
+        from requests.adapters import HTTPAdapter
+
+        class RecordAdapter(HTTPAdapter):
+            def send(self, request, stream=False, **kwargs):
+                key = request_key(request.method, request.url, request.body)
+                start = time.monotonic()
+                try:
+                    response = super().send(request, stream=stream, **kwargs)
+                except Exception as e:
+                    _record({'key': key, 'error': f"{type(e).__name__}: {e}", 'elapsed': round(time.monotonic() - start, 4)})
+                    raise
+                # streamed downloads are not read here: the caller only needs the first bytes
+                content = None if stream else response.content
+                entry = {'key': key, 'status': response.status_code, 'elapsed': round(time.monotonic() - start, 4),
+                         'headers': {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers}}
+                entry.update(_encode_body(content))
+                _record(entry)
+                return response
+
+        return RecordAdapter()
+
+class _ReplayAdapter:
+    def __new__(cls):
+        import requests
+        from requests.adapters import BaseAdapter
+        from requests.structures import CaseInsensitiveDict
+
+        class ReplayAdapter(BaseAdapter):
+            def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+                key = request_key(request.method, request.url, request.body)
+                entry = _answer(key)
+                if entry is None:
+                    raise requests.exceptions.ConnectionError(f"not in the fixture: {key}", request=request)
+                if 'error' in entry:
+                    raise requests.exceptions.ConnectionError(f"replayed: {entry['error']}", request=request)
+                response = requests.Response()
+                response.status_code = entry['status']
+                response.headers = CaseInsensitiveDict(entry.get('headers') or {})
+                response._content = _decode_body(entry)
+                response._content_consumed = True
+                response.encoding = 'utf-8'
+                response.url = request.url
+                response.request = request
+                response.reason = "Replayed"
+                return response
+
+            def close(self):
+                pass
+
+        return ReplayAdapter()
+
+# --- urllib (ListenBrainz) ---
+
+class _UrlResponse:
+    def __init__(self, status, body, headers):
+        self.status = status
+        self._body = body
+        self.headers = headers
+
+    def read(self):
+        return self._body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def _headers(values):
+    headers = Message()
+    for name, value in (values or {}).items():
+        headers[name] = value
+    return headers
+
+def urlopen(req, timeout):
+    """urllib.request.urlopen() that records or replays the call."""
+    if _mode is None:
+        return urllib.request.urlopen(req, timeout=timeout)
+    key = request_key(req.get_method(), req.full_url, req.data)
+    if _mode == 'replay':
+        entry = _answer(key)
+        if entry is None:
+            raise urllib.error.URLError(f"not in the fixture: {key}")
+        if 'error' in entry:
+            raise urllib.error.URLError(f"replayed: {entry['error']}")
+        headers = _headers(entry.get('headers'))
+        if entry['status'] >= 400:
+            raise urllib.error.HTTPError(req.full_url, entry['status'], "Replayed", headers, None)
+        return _UrlResponse(entry['status'], _decode_body(entry), headers)
+
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as r:
+            body = r.read()
+            status = r.status
+            headers = {h: r.headers[h] for h in KEPT_HEADERS if r.headers.get(h)}
+    except urllib.error.HTTPError as e:
+        _record({'key': key, 'status': e.code, 'elapsed': round(time.monotonic() - start, 4),
+                 'headers': {h: e.headers[h] for h in KEPT_HEADERS if e.headers and e.headers.get(h)}})
+        raise
+    except OSError as e:
+        _record({'key': key, 'error': f"{type(e).__name__}: {e}", 'elapsed': round(time.monotonic() - start, 4)})
+        raise
+    entry = {'key': key, 'status': status, 'elapsed': round(time.monotonic() - start, 4), 'headers': headers}
+    entry.update(_encode_body(body))
+    _record(entry)
+    return _UrlResponse(status, body, _headers(headers))
+
+# --- yt-dlp ---
+
+def _compact_search(result):
+    if not result:
+        return None
+    return {'entries': [{k: e.get(k) for k in YT_ENTRY_KEYS if e.get(k) is not None} if e else None
+                        for e in result.get('entries') or []]}
+
+class _RecordingYDL:
+    def __init__(self, ydl):
+        self._ydl = ydl
+
+    def __enter__(self):
+        self._ydl.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._ydl.__exit__(*exc)
+
+    def extract_info(self, query, download=False):
+        start = time.monotonic()
+        result = self._ydl.extract_info(query, download=download)
+        _record({'key': f"YTSEARCH {query}", 'result': _compact_search(result),
+                 'elapsed': round(time.monotonic() - start, 4)})
+        return result
+
+    def download(self, urls):
+        start = time.monotonic()
+        try:
+            code = self._ydl.download(urls)
+        except Exception as e:
+            _record({'key': f"YTDL {' '.join(urls)}", 'error': f"{type(e).__name__}: {e}",
+                     'elapsed': round(time.monotonic() - start, 4)})
+            raise
+        _record({'key': f"YTDL {' '.join(urls)}", 'result': code, 'elapsed': round(time.monotonic() - start, 4)})
+        return code
+
+class _ReplayYDL:
+    """Answers yt-dlp calls from the fixture: no network, downloads write nothing."""
+    def __init__(self, opts):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, query, download=False):
+        entry = _answer(f"YTSEARCH {query}")
+        return entry.get('result') if entry else None
+
+    def download(self, urls):
+        entry = _answer(f"YTDL {' '.join(urls)}")
+        if entry is None or 'error' in entry:
+            raise RuntimeError(entry['error'] if entry else f"not in the fixture: {' '.join(urls)}")
+        return entry.get('result', 0)
+
+def download_outcome(url):
+    """Recorded result of youtube.download_yt(url) in a replayed run (nothing is written)."""
+    try:
+        _ReplayYDL(None).download([url])
+    except RuntimeError as e:
+        log.info("[Replay] YouTube download failed when recorded: %s", e)
+        return False
+    return True
+
+def youtube_dl(opts):
+    """yt_dlp.YoutubeDL(opts), recorded or replayed from the fixture (no yt-dlp import when replaying)."""
+    if _mode == 'replay':
+        return _ReplayYDL(opts)
+    import yt_dlp
+    ydl = yt_dlp.YoutubeDL(opts)
+    return _RecordingYDL(ydl) if _mode == 'record' else ydl
@@ -0,0 +1,267 @@
+import json
+import os
+import sqlite3
+import time
+import logging
+from models import Track
+
+log = logging.getLogger(__name__)
+
+# Local state of every run (replaces the data.json / old_data.json pair).
+# Each write is its own small transaction, so an interrupted run keeps what it already resolved.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    playlist_name TEXT NOT NULL UNIQUE,
+    mbid TEXT,
+    status TEXT NOT NULL DEFAULT 'running', -- running / done
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    artist TEXT NOT NULL,
+    title TEXT NOT NULL,
+    album TEXT NOT NULL DEFAULT '',
+    UNIQUE (artist, title, album)
+);
+CREATE TABLE IF NOT EXISTS resolutions (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    track_id INTEGER NOT NULL REFERENCES tracks(id),
+    song_id TEXT,              -- Subsonic id, NULL when not found
+    source TEXT NOT NULL,      -- local / subsonic / youtube / not_found
+    similarity REAL,
+    resolved_at REAL NOT NULL,
+    PRIMARY KEY (run_id, track_id)
+);
+CREATE INDEX IF NOT EXISTS idx_resolutions_song ON resolutions(song_id);
+CREATE TABLE IF NOT EXISTS downloads (
+    song_id TEXT PRIMARY KEY,  -- files written on disk by this script
+    source TEXT NOT NULL,      -- subsonic / youtube
+    run_id INTEGER REFERENCES runs(id) ON DELETE SET NULL,
+    downloaded_at REAL NOT NULL,
+    deleted_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_downloads_live ON downloads(deleted_at);
+CREATE TABLE IF NOT EXISTS playlist_members (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    song_id TEXT NOT NULL,
+    PRIMARY KEY (run_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_members_song ON playlist_members(song_id);
+CREATE TABLE IF NOT EXISTS mbid_songs (
+    mbid TEXT PRIMARY KEY,     -- MusicBrainz recording id
+    song_id TEXT NOT NULL,     -- local Subsonic song
+    source TEXT NOT NULL,      -- library (musicBrainzId tag) / resolved (matched by a previous run)
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_mbid_songs_song ON mbid_songs(song_id);
+"""
+
+_conn = None
+_path = None
+
+def configure(path="state.db", scratch=False):
+    """
+    Opens (and creates if needed) the state database. Legacy data.json files are imported once.
+    scratch=True works on an in-memory copy of it (replayed runs): nothing is ever written to path.
+    """
+    global _conn, _path
+    if _conn is not None:
+        if _path == (path, scratch):
+            return _conn
+        _conn.close()
+    _path = (path, scratch)
+    if scratch:
+        _conn = sqlite3.connect(":memory:")
+        if os.path.exists(path):
+            source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            source.backup(_conn)
+            source.close()
+    else:
+        _conn = sqlite3.connect(path)
+    _conn.row_factory = sqlite3.Row
+    _conn.execute("PRAGMA foreign_keys = ON")
+    _conn.execute("PRAGMA journal_mode = WAL")
+    _conn.executescript(SCHEMA)
+    import_legacy_json()
+    return _conn
+
+def get_conn():
+    if _conn is None:
+        configure()
+    return _conn
+
+# --- Runs ---
+
+def last_run():
+    """Returns the last completed run (sqlite3.Row) or None."""
+    return get_conn().execute(
+        "SELECT * FROM runs WHERE status = 'done' ORDER BY finished_at DESC, id DESC LIMIT 1"
+    ).fetchone()
+
+def is_processed(playlist_name):
+    row = get_conn().execute(
+        "SELECT 1 FROM runs WHERE playlist_name = ? AND status = 'done'", (playlist_name,)
+    ).fetchone()
+    return row is not None
+
+def start_run(playlist_name, mbid):
+    """Creates the run row. An interrupted run of the same playlist is reset and reused."""
+    conn = get_conn()
+    with conn:
+        row = conn.execute("SELECT id FROM runs WHERE playlist_name = ?", (playlist_name,)).fetchone()
+        if row:
+            run_id = row['id']
+            conn.execute("DELETE FROM resolutions WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM playlist_members WHERE run_id = ?", (run_id,))
+            conn.execute("UPDATE runs SET mbid = ?, status = 'running', started_at = ?, finished_at = NULL WHERE id = ?",
+                         (mbid, time.time(), run_id))
+            return run_id
+        cur = conn.execute("INSERT INTO runs (playlist_name, mbid, started_at) VALUES (?, ?, ?)",
+                           (playlist_name, mbid, time.time()))
+        return cur.lastrowid
+
+def finish_run(run_id, playlist_ids):
+    """Stores the final playlist content and marks the run as done."""
+    conn = get_conn()
+    with conn:
+        conn.execute("DELETE FROM playlist_members WHERE run_id = ?", (run_id,))
+        conn.executemany("INSERT INTO playlist_members (run_id, position, song_id) VALUES (?, ?, ?)",
+                         [(run_id, pos, song_id) for pos, song_id in enumerate(playlist_ids)])
+        conn.execute("UPDATE runs SET status = 'done', finished_at = ? WHERE id = ?", (time.time(), run_id))
+
+# --- Tracks & resolutions ---
+
+def _track_id(conn, track):
+    row = track.as_row()
+    conn.execute("INSERT OR IGNORE INTO tracks (artist, title, album) VALUES (?, ?, ?)", row)
+    return conn.execute("SELECT id FROM tracks WHERE artist = ? AND title = ? AND album = ?", row).fetchone()['id']
+
+def record_resolution(run_id, track, song_id, source, similarity=None):
+    """Stores how a ListenBrainz Track was resolved in this run."""
+    conn = get_conn()
+    with conn:
+        track_id = _track_id(conn, track)
+        conn.execute(
+            "INSERT OR REPLACE INTO resolutions (run_id, track_id, song_id, source, similarity, resolved_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (run_id, track_id, song_id, source, similarity, time.time()))
+
+def resolved_tracks(run_id):
+    """
+    {(artist, title): Row(song_id, source, similarity)} for the tracks a run found and that are still there:
+    library tracks, and downloads not deleted since.
+    """
+    rows = get_conn().execute(
+        "SELECT t.artist, t.title, r.song_id, r.source, r.similarity FROM resolutions r "
+        "JOIN tracks t ON t.id = r.track_id "
+        "LEFT JOIN downloads d ON d.song_id = r.song_id "
+        "WHERE r.run_id = ? AND r.song_id IS NOT NULL AND d.deleted_at IS NULL", (run_id,)
+    ).fetchall()
+    return {(r['artist'], r['title']): r for r in rows}
+
+def record_download(run_id, song_id, source):
+    """Marks a song id as a file written by this script (candidate for later cleanup)."""
+    conn = get_conn()
+    with conn:
+        conn.execute(
+            "INSERT INTO downloads (song_id, source, run_id, downloaded_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(song_id) DO UPDATE SET source = excluded.source, run_id = excluded.run_id, "
+            "downloaded_at = excluded.downloaded_at, deleted_at = NULL",
+            (song_id, source, run_id, time.time()))
+
+# --- Cleanup ---
+
+def cleanup_candidates(run_id):
+    """
+    Songs of a run's playlist that were downloaded by the script and are still on disk.
+    Tracks that were already in the library before (never downloaded by us) are never returned.
+    """
+    rows = get_conn().execute(
+        "SELECT DISTINCT pm.song_id FROM playlist_members pm "
+        "JOIN downloads d ON d.song_id = pm.song_id "
+        "WHERE pm.run_id = ? AND d.deleted_at IS NULL ORDER BY pm.position", (run_id,)
+    ).fetchall()
+    return [r['song_id'] for r in rows]
+
+# --- MusicBrainz id -> song id ---
+
+def mbid_song_ids():
+    """{recording MBID: song_id} from the last library index and from previous resolutions."""
+    rows = get_conn().execute("SELECT mbid, song_id FROM mbid_songs").fetchall()
+    return {r['mbid']: r['song_id'] for r in rows}
+
+def mbid_index_age():
+    """Seconds since the library index was last saved, None when there is none."""
+    row = get_conn().execute("SELECT MAX(updated_at) AS at FROM mbid_songs WHERE source = 'library'").fetchone()
+    return time.time() - row['at'] if row['at'] is not None else None
+
+def remember_mbid(mbid, song_id):
+    """Keeps a match found by a run, so the next runs resolve this recording without searching."""
+    conn = get_conn()
+    with conn:
+        conn.execute("INSERT INTO mbid_songs (mbid, song_id, source, updated_at) VALUES (?, ?, 'resolved', ?) "
+                     "ON CONFLICT(mbid) DO UPDATE SET song_id = excluded.song_id, source = excluded.source, "
+                     "updated_at = excluded.updated_at WHERE mbid_songs.source = 'resolved'",
+                     (mbid, song_id, time.time()))
+
+def save_mbid_index(index, library_ids):
+    """
+    Replaces the library part of the mapping with a fresh index ({mbid: song_id}) and drops the
+    resolved entries pointing to songs that are no longer in the library (library_ids).
+    """
+    conn = get_conn()
+    now = time.time()
+    with conn:
+        conn.execute("DELETE FROM mbid_songs WHERE source = 'library'")
+        stale = [r['mbid'] for r in conn.execute("SELECT mbid, song_id FROM mbid_songs").fetchall()
+                 if r['song_id'] not in library_ids]
+        conn.executemany("DELETE FROM mbid_songs WHERE mbid = ?", [(m,) for m in stale])
+        conn.executemany("INSERT OR REPLACE INTO mbid_songs (mbid, song_id, source, updated_at) VALUES (?, ?, 'library', ?)",
+                         [(mbid, song_id, now) for mbid, song_id in index.items()])
+
+def live_downloads():
+    """{song_id: downloaded_at} of every file downloaded by the script and still on disk (all runs)."""
+    rows = get_conn().execute("SELECT song_id, downloaded_at FROM downloads WHERE deleted_at IS NULL").fetchall()
+    return {r['song_id']: r['downloaded_at'] for r in rows}
+
+def mark_deleted(song_ids):
+    conn = get_conn()
+    now = time.time()
+    with conn:
+        conn.executemany("UPDATE downloads SET deleted_at = ? WHERE song_id = ?", [(now, s) for s in song_ids])
+        conn.executemany("DELETE FROM mbid_songs WHERE song_id = ?", [(s,) for s in song_ids])
+
+# --- Migration from data.json ---
+
+def import_legacy_json(paths=('old_data.json', 'data.json')):
+    """Imports the old JSON state files (oldest first) when the database is still empty."""
+    conn = get_conn()
+    if conn.execute("SELECT 1 FROM runs LIMIT 1").fetchone():
+        return
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            log.warning("Warning: Could not import %s: %s", path, e)
+            continue
+        name = data.get('playlist_name')
+        if not name:
+            continue
+        run_id = start_run(name, None)
+        for track in data.get('already_local', []):
+            if 'download_id' in track:
+                record_resolution(run_id, Track.from_dict(track), track['download_id'], 'local', track.get('similarity'))
+        for song_id in data.get('subsonic_downloaded', []):
+            record_download(run_id, song_id, 'subsonic')
+        for song_id in data.get('youtube_downloaded', []):
+            record_download(run_id, song_id, 'youtube')
+        for track in data.get('not_found', []):
+            record_resolution(run_id, Track.from_dict(track), None, 'not_found')
+        finish_run(run_id, data.get('all_tracks_ids', []))
+        log.info("Imported legacy state file %s (%s) into the state database.", path, name)
@@ -1,9 +1,60 @@
 import requests
 import time
 import utility
+import ratelimit
+import deadline
+import hedge
+import replay
 import os
-from thefuzz import fuzz
 import re
+from datetime import datetime
+import logging
+from models import Candidate
+
+log = logging.getLogger(__name__)
+
+# Kept for the whole life of the process: in daemon mode connections and matches stay warm between runs
+_session = None
+_match_cache = {} # (artist, title, duration) -> (cached at, search_octo results that contain a local track)
+# songs may also disappear outside the script (deleted by the user, Octo-Fiesta expiry): matches are not kept forever
+MATCH_CACHE_TTL = 6 * 3600
+MATCH_CACHE_MAX = 20000
+_prefetched = {} # (artist, title) -> matches found by a grouped search, consumed by search_octo
+
+# Idempotent reads that may be duplicated when slow (hedge.py, HEDGE_REQUESTS)
+HEDGED_ENDPOINTS = ('search3', 'getSong', 'getPlaylist', 'getScanStatus')
+
+def get_session():
+    """Returns the shared HTTP session (keep-alive connections to the Subsonic server)."""
+    global _session
+    if _session is None:
+        # HTTP_RECORD / HTTP_REPLAY: the session goes through the fixture adapter
+        _session = replay.mount(requests.Session())
+    return _session
+
+def forget_songs(song_ids):
+    """Drops cached matches pointing to songs that no longer exist (deleted during cleanup)."""
+    song_ids = set(song_ids)
+    for key, (_, tracks) in list(_match_cache.items()):
+        if any(t.id in song_ids for t in tracks):
+            del _match_cache[key]
+
+def _cached_matches(key):
+    """search_octo results cached for key, None when missing or older than MATCH_CACHE_TTL."""
+    entry = _match_cache.get(key)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[0] > MATCH_CACHE_TTL:
+        del _match_cache[key]
+        return None
+    return entry[1]
+
+def _cache_matches(key, tracks):
+    _match_cache.pop(key, None)
+    if len(_match_cache) >= MATCH_CACHE_MAX:
+        # dicts keep insertion order: the oldest entry goes first
+        del _match_cache[next(iter(_match_cache))]
+    _match_cache[key] = (time.monotonic(), tracks)
 
 def subsonic_error_from_json(data):
     """Checks if the Subsonic response contains a failed status and returns the error code/message."""
@@ -18,57 +69,93 @@ def subsonic_error_from_json(data):
         pass
     return None
 
-def subsonic_get_json(url, params, tries=3, timeout=30):
-    """Performs a GET request to the Subsonic API with retry logic and JSON validation."""
+def subsonic_get_json(url, params, tries=3, timeout=30, method='GET', not_found=None):
+    """
+    Performs a request to the Subsonic API with retry logic and JSON validation.
+    With method='POST' the parameters are sent form-encoded in the body (no URL length limit).
+    not_found is returned instead of None when the server answers "data not found" (error 70).
+    Timeouts and retries are bounded by the run deadline / step budget and the run retry budget.
+    """
     last_exc = None
     for attempt in range(1, tries + 1):
+        if not deadline.can_call('subsonic'):
+            return None
+        ratelimit.acquire('subsonic')
+        start = time.monotonic()
+        retry_after = None # set from the answer, if there is one
         try:
-            r = requests.get(url, params=params, timeout=timeout)
+            call_timeout = deadline.clamp(timeout)
+            endpoint = url.rsplit('/', 1)[-1]
+            if method == 'POST':
+                r = get_session().post(url, data=params, timeout=call_timeout)
+            elif endpoint in HEDGED_ENDPOINTS:
+                r = hedge.call(endpoint, lambda: get_session().get(url, params=params, timeout=call_timeout),
+                               before_hedge=lambda: ratelimit.acquire('subsonic'), ok=lambda r: r.ok)
+            else:
+                r = get_session().get(url, params=params, timeout=call_timeout)
+            retry_after = ratelimit.parse_retry_after(r.headers.get('Retry-After'))
+            ratelimit.feedback('subsonic', status=r.status_code, latency=time.monotonic() - start, retry_after=retry_after)
             r.raise_for_status()
             # JSON decode
             data = r.json()
+            deadline.record_success('subsonic')
             # Check Subsonic "status"
             err = subsonic_error_from_json(data)
             if err:
                 code, msg = err
-                print(f"[Subsonic FAILED] {url} code={code} message={msg}")
+                if code == 70 and not_found is not None:
+                    return not_found
+                log.warning("[Subsonic FAILED] %s code=%s message=%s", url, code, msg)
                 return None
             return data
         except requests.exceptions.RequestException as e:
             last_exc = e
-            wait = 2 ** (attempt - 1)
-            print(f"[Network error] {url} attempt {attempt}/{tries}: {e} (retry in {wait}s)")
-            time.sleep(wait)
+            deadline.record_failure('subsonic')
+            if e.response is None:
+                ratelimit.feedback('subsonic', error=True)
+            wait = retry_after or 2 ** (attempt - 1)
+            if attempt == tries or not deadline.allow_retry('subsonic', wait):
+                break
+            log.warning("[Network error] %s attempt %s/%s: %s (retry in %ss)", url, attempt, tries, e, wait)
+            replay.sleep(wait)
 
         except ValueError as e:
             # JSON invalide
-            print(f"[JSON decode error] {url}: {e}")
+            log.warning("[JSON decode error] %s: %s", url, e)
             return None
-    print(f"[Giving up] {url}: {last_exc}")
+    log.warning("[Giving up] %s: %s", url, last_exc)
     return None
 
 def perform_requests(url, params):
     return subsonic_get_json(url, params, tries=3, timeout=30)
     
-def parse_search(data, target_artist, target_title):
+def parse_search(data, target_artist, target_title, target_duration=None):
     """
     Parses Subsonic search results and calculates similarity scores.
     Optimizes results by cleaning titles and checking for artist inclusions.
+    Songs whose duration is too far from target_duration are rejected before any scoring.
     """
     if not data or 'subsonic-response' not in data or 'searchResult3' not in data['subsonic-response']:
             return []
         
     search_res = data['subsonic-response']['searchResult3']
     if 'song' not in search_res:
-            print(f"   [DEBUG] No songs found in this search batch.")
+            log.debug("   [DEBUG] No songs found in this search batch.")
             return []
             
     tracks = search_res['song']
-    tracks_dict = []
+    candidates = []
     
-    print(f"   [DEBUG] Found {len(tracks)} candidates. processing...")
+    log.debug("   [DEBUG] Found %s candidates. processing...", len(tracks))
+    # the per-candidate dump is the hottest log site: decide once per batch
+    debug = log.isEnabledFor(logging.DEBUG)
 
     for track in tracks:
+        if utility.duration_mismatch(target_duration, track.get('duration')):
+            if debug:
+                log.debug("      [Candidate] %s - %s rejected: %ss instead of %ss",
+                          track.get('artist'), track.get('title'), track.get('duration'), target_duration)
+            continue
         track_artist = track['artist']
         track_title = track['title']
         
@@ -99,32 +186,132 @@ def parse_search(data, target_artist, target_title):
              artist_included = True
 
         # --- DEBUG LOGS ---
-        if similarity_note > 0.1:
-            print(f"      [Candidate] {track_artist} - {track_title}")
-            print(f"          Target: {target_artist} - {target_title}")
-            print(f"          Raw Score: {raw_score:.2f}")
+        if debug and similarity_note > 0.1:
+            log.debug("      [Candidate] %s - %s", track_artist, track_title)
+            log.debug("          Target: %s - %s", target_artist, target_title)
+            log.debug("          Raw Score: %.2f", raw_score)
             if score_boosted:
-                print(f"          Cleaned Title Attempt: '{clean_track_title}'")
-                print(f"          New Score: {similarity_note:.2f}")
-            print(f"          -> Final Decision: {'KEEP' if similarity_note >= 0.80 else 'REJECT'}")
-            print("-" * 10)
+                log.debug("          Cleaned Title Attempt: '%s'", clean_track_title)
+                log.debug("          New Score: %.2f", similarity_note)
+            log.debug("          -> Final Decision: %s", 'KEEP' if similarity_note >= 0.80 else 'REJECT')
         # ------------------
 
         if similarity_note < 0.80:
             continue
             
-        track_info = {
-            "title": track_title,
-            "artist": track_artist,
-            "similarity": similarity_note,
-            "download_id": track['id'],
-            "isexternal": track['isExternal']
+        candidates.append(Candidate(track['id'], track_artist, track_title, similarity_note, track['isExternal']))
+    return candidates
+
+def plan_searches(songs, min_group=2):
+    """
+    Groups the playlist Tracks by artist MBID, or cleaned artist name when there is none
+    (tracks already matched are left out).
+    Returns a list of (query, songs) for the artists appearing at least min_group times:
+    the query is the artist, plus the album when the whole group comes from the same album.
+    """
+    groups = {}
+    for song in songs:
+        if _cached_matches((song.artist, song.title, song.duration)) is not None:
+            continue
+        key = song.artist_mbids[0] if song.artist_mbids else utility.clean_artist_name(song.artist).lower().strip()
+        if key:
+            groups.setdefault(key, []).append(song)
+    plan = []
+    for group in groups.values():
+        if len(group) < min_group:
+            continue
+        artist = utility.clean_artist_name(group[0].artist)
+        albums = {(s.album or '').lower() for s in group}
+        album = group[0].album if len(albums) == 1 else None
+        plan.append((f"{artist} {album}" if album else artist, group))
+    return plan
+
+def prefetch_searches(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, songs, min_group=2, max_song_count=500):
+    """
+    Sends one broad search3 per group of plan_searches() (bigger songCount) and matches every title
+    of the group against that single result set in memory. search_octo() starts from these matches
+    and skips its own queries when a local copy was found. Returns the number of grouped requests sent.
+    """
+    _prefetched.clear()
+    url = SUBSONIC_URL + "/rest/search3"
+    plan = plan_searches(songs, min_group)
+    sent = 0
+    for query, group in plan:
+        if deadline.expired():
+            break
+        params = {
+            'u': SUBSONIC_USER,
+            'p': SUBSONIC_PASS,
+            'v': '1.16.1',
+            'c': 'python-script',
+            'f': 'json',
+            'query': query,
+            'songCount': min(max_song_count, max(50, 20 * len(group))),
+            'artistCount': 0,
+            'albumCount': 0
         }
-        tracks_dict.append(track_info)
-    return tracks_dict
+        data = perform_requests(url, params)
+        sent += 1
+        if not data:
+            continue
+        for song in group:
+            results = parse_search(data, song.artist, song.title, song.duration)
+            if results:
+                _prefetched[song.key] = results
+    log.info("Grouped search: %s request(s) for %s song(s), %s matched in memory.",
+             sent, sum(len(group) for _, group in plan), len(_prefetched))
+    return sent
+
+def build_mbid_index(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, page_size=500):
+    """
+    Reads the whole local library with paged empty search3 queries.
+    Returns ({recording MBID: song id}, {every local song id}), or None if the library could not be fully read.
+    """
+    url = SUBSONIC_URL + "/rest/search3"
+    params = {
+        'u': SUBSONIC_USER,
+        'p': SUBSONIC_PASS,
+        'v': '1.16.1',
+        'c': 'python-script',
+        'f': 'json',
+        'query': '',
+        'songCount': page_size,
+        'songOffset': 0,
+        'artistCount': 0,
+        'albumCount': 0
+    }
+    index = {}
+    library_ids = set()
+    while True:
+        data = perform_requests(url, params)
+        if not data:
+            return None
+        songs = data['subsonic-response'].get('searchResult3', {}).get('song', [])
+        for song in songs:
+            if song.get('isExternal'):
+                continue
+            library_ids.add(song['id'])
+            mbid = song.get('musicBrainzId')
+            if mbid:
+                index.setdefault(mbid, song['id'])
+        if len(songs) < page_size:
+            break
+        params['songOffset'] += page_size
+    log.info("MBID index: %s songs in the library, %s with a MusicBrainz id (%s request(s)).",
+             len(library_ids), len(index), params['songOffset'] // page_size + 1)
+    return index, library_ids
+
+def search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, artist, title, duration=None):
+    """
+    Searches the Subsonic server (and Octo-Fiesta) using multiple query variations.
+    duration (seconds, optional) rejects songs of another length (live, edit, teaser).
+    """
+    # the duration filter changes the results: it is part of the key
+    cache_key = (artist, title, duration)
+    cached = _cached_matches(cache_key)
+    if cached is not None:
+        return list(cached)
 
-def search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, artist, title):
-    """Searches the Subsonic server (and Octo-Fiesta) using multiple query variations."""
     url = SUBSONIC_URL+"/rest/search3"
     query = f"{artist} {title}"
     base_params = {
@@ -147,31 +334,37 @@ def search_octo(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, artist, title):
         f"{cleaned_artist} {title}",
         f"{artist} {cleaned_title}"
     ]
-    all_tracks_found = []
+    # matches from the grouped artist/album search (prefetch_searches), if any
+    all_tracks_found = list(_prefetched.pop((artist, title), []))
     for query in search_queries:
         # if perfect local match already exist : stop
-        if any(t['isexternal'] is False and t['similarity'] > 0.9 for t in all_tracks_found):
+        if any(not t.external and t.similarity > 0.9 for t in all_tracks_found):
             break
         params = base_params.copy()
         params['query'] = query
         # get all the 50 search result 
         data = perform_requests(url, params)
+        if data is None and deadline.cut_short():
+            break # refused (budget, breaker): the next queries would be too, the caller stops the run
         # get the similarity between request and found tracks, if < 80 don't keep it
-        results = parse_search(data, artist, title)
-        # results is from each similare tracks : track title, artist, similarity note, download_id and isexternal value
+        results = parse_search(data, artist, title, duration)
+        # results is a list of Candidate (id, artist, title, similarity, external) for the similar tracks
         all_tracks_found.extend(results)
-    unique_tracks = {t['download_id']: t for t in all_tracks_found}.values() # get only unique ID of tracks founds from octo-fiesta
+    unique_tracks = list({t.id: t for t in all_tracks_found}.values()) # get only unique ID of tracks founds from octo-fiesta
+    # only local results are cached: external ones change state once downloaded
+    if any(not t.external for t in unique_tracks):
+        _cache_matches(cache_key, unique_tracks)
     return list(unique_tracks)
     
 def compare_tracks(tracks_dict):
     """Prioritizes local tracks over external ones, then picks the highest similarity."""
     if tracks_dict:
-        result = max(tracks_dict, key=lambda x: (not x['isexternal'], x['similarity'])) 
+        result = max(tracks_dict, key=lambda x: (not x.external, x.similarity))
         return result
     return None
 
 def download_tracks(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, id):
-    """Triggers a download/stream on the Subsonic server (used for Octo-Fiesta integration)."""
+    """Triggers a download/stream on the Subsonic server (used for Octo-Fiesta integration). True when triggered."""
     url = SUBSONIC_URL+"/rest/stream"
     params = {
         'u': SUBSONIC_USER,
@@ -181,15 +374,27 @@ def download_tracks(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, id):
         'id': id,
         'maxBitRate': 1 # Optionnel : demande du mp3 pour aller plus vite, Octo téléchargera quand même le max dispo
     }
+    if not deadline.can_call('octo_trigger'):
+        return None
+    # Octo-Fiesta starts a full download for each trigger: paced by its own bucket
+    ratelimit.acquire('octo_trigger')
+    start = time.monotonic()
     try:
         # stream=True est CRUCIAL ici
-        with requests.get(url, params=params, stream=True, timeout=10) as r:
+        with get_session().get(url, params=params, stream=True, timeout=deadline.clamp(10)) as r:
+            ratelimit.feedback('octo_trigger', status=r.status_code, latency=time.monotonic() - start,
+                               retry_after=ratelimit.parse_retry_after(r.headers.get('Retry-After')))
             r.raise_for_status()
             for _ in r.iter_content(chunk_size=1024):
                 break 
-        print(f"Download trigger successful for ID: {id} (Trigger only)")
+        deadline.record_success('octo_trigger')
+        log.info("Download trigger successful for ID: %s (Trigger only)", id)
+        return True
     except Exception as e:
-        print(f"Error triggering download: {e}")
+        deadline.record_failure('octo_trigger')
+        if getattr(e, 'response', None) is None:
+            ratelimit.feedback('octo_trigger', error=True)
+        log.warning("Error triggering download: %s", e)
         return None
     
 def start_scan(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
@@ -205,19 +410,22 @@ def start_scan(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
     }
 
     if not subsonic_get_json(scan_url, params, tries=3, timeout=30):
-        print("startScan failed.")
+        log.warning("startScan failed.")
         return None
-    print("Scan command sent")
-    time.sleep(2)
+    log.info("Scan command sent")
+    replay.sleep(2)
     consecutive_fail = 0
     while True:
+        if deadline.expired():
+            log.info("Scan wait aborted: %s.", deadline.describe())
+            return None
         data = subsonic_get_json(status_url, params, tries=1, timeout=30)
         if not data:
             consecutive_fail +=1
             if consecutive_fail >= 10:
-                print("Too many failures reading scan status. Aborting scan wait.")
+                log.warning("Too many failures reading scan status. Aborting scan wait.")
                 return None
-            time.sleep(2)
+            replay.sleep(2)
             continue
 
         consecutive_fail = 0
@@ -225,33 +433,130 @@ def start_scan(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
         is_scanning = scan_status.get('scanning')
         count = scan_status.get('count', 0)
         if is_scanning is False:
-            print(f"\nScan finished. Total items scanned: {count}")
+            log.info("Scan finished. Total items scanned: %s", count)
             break
 
-        print(f"Scanning in progress... ({count} items)", end="\r")
-        time.sleep(2)
+        log.debug("Scanning in progress... (%s items)", count)
+        replay.sleep(2)
 
-    print("\nScan ended.")
+    log.info("Scan ended.")
     return True
 
 
-def create_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_name, songs_id):
-    url = SUBSONIC_URL+"/rest/createPlaylist"
+def find_playlist_id(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_name):
+    """Returns the id of the last playlist called playlist_name, None if there is none."""
+    found = None
+    for playlist in get_all_playlists(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
+        if playlist.get('name') == playlist_name:
+            found = playlist.get('id')
+    return found
+
+def create_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_name, songs_id, chunk_size=200, tries=3):
+    """
+    Creates the playlist with form-encoded POSTs: the first chunk_size songs go with createPlaylist,
+    the rest is appended with updatePlaylist, chunk_size songs per call.
+    Returns the playlist id (None if the playlist could not be created).
+    """
+    base_params = {
+        'u': SUBSONIC_USER,
+        'p': SUBSONIC_PASS,
+        'v': '1.16.1',
+        'c': 'python-script',
+        'f': 'json',
+    }
+    chunk_size = max(1, chunk_size)
+    chunks = [songs_id[i:i + chunk_size] for i in range(0, len(songs_id), chunk_size)] or [[]]
+
+    params = dict(base_params, name=playlist_name, songId=chunks[0])
+    playlist_id = None
+    for attempt in range(1, tries + 1):
+        # createPlaylist is not idempotent: each attempt is a single call, followed by a lookup by name
+        data = subsonic_get_json(SUBSONIC_URL + "/rest/createPlaylist", params, tries=1, timeout=30, method='POST')
+        if data:
+            playlist_id = data['subsonic-response'].get('playlist', {}).get('id')
+        if not playlist_id:
+            # servers older than API 1.14 return an empty body, and a failed call may have gone through
+            playlist_id = find_playlist_id(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_name)
+        if playlist_id:
+            break
+        wait = 2 ** attempt
+        if attempt == tries or not deadline.allow_retry('subsonic', wait):
+            break
+        log.warning("createPlaylist '%s' failed, attempt %s/%s (retry in %ss)", playlist_name, attempt, tries, wait)
+        replay.sleep(wait)
+    if not playlist_id:
+        log.info("Playlist NOT created: '%s'", playlist_name)
+        return None
+
+    added = len(chunks[0])
+    for chunk in chunks[1:]:
+        params = dict(base_params, playlistId=playlist_id, songIdToAdd=chunk)
+        if not subsonic_get_json(SUBSONIC_URL + "/rest/updatePlaylist", params, tries=3, timeout=30, method='POST'):
+            log.warning("Playlist '%s' only partially filled: %s/%s titles added.", playlist_name, added, len(songs_id))
+            return playlist_id
+        added += len(chunk)
+    log.info("Playlist '%s' created with %s titles (%s request(s))", playlist_name, added, len(chunks))
+    return playlist_id
+
+def get_playlist_entries(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_id):
+    """Song ids of a playlist in order (None if the playlist could not be read)."""
     params = {
         'u': SUBSONIC_USER,
         'p': SUBSONIC_PASS,
         'v': '1.16.1',
         'c': 'python-script',
         'f': 'json',
-        'name': playlist_name,
-        'songId': songs_id
+        'id': playlist_id
     }
-    data = subsonic_get_json(url, params, tries=3, timeout=30)
+    data = subsonic_get_json(SUBSONIC_URL + "/rest/getPlaylist", params)
     if not data:
-        print(f"Playlist NOT created: '{playlist_name}'")
         return None
-    print(f"Playlist '{playlist_name}' created with {len(songs_id)} titles")
-    return data
+    entries = data['subsonic-response'].get('playlist', {}).get('entry', [])
+    return [e.get('id') for e in entries]
+
+def update_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_id, playlist_name, songs_id, chunk_size=200):
+    """
+    Turns an existing playlist into `songs_id` in place: renames it, removes the songs that left
+    (and duplicates) and appends the new ones. Kept songs are not touched.
+    Returns False when the playlist could not be read or updated (caller can rebuild it).
+    """
+    current = get_playlist_entries(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_id)
+    if current is None:
+        return False
+    wanted = set(songs_id)
+    present = set()
+    to_remove = []
+    for index, song_id in enumerate(current):
+        if song_id not in wanted or song_id in present:
+            to_remove.append(index)
+        else:
+            present.add(song_id)
+    to_add = [song_id for song_id in dict.fromkeys(songs_id) if song_id not in present]
+
+    base_params = {
+        'u': SUBSONIC_USER,
+        'p': SUBSONIC_PASS,
+        'v': '1.16.1',
+        'c': 'python-script',
+        'f': 'json',
+        'playlistId': playlist_id,
+    }
+    url = SUBSONIC_URL + "/rest/updatePlaylist"
+    chunk_size = max(1, chunk_size)
+    # highest indexes first: removing them does not shift the indexes of the following chunks
+    to_remove.sort(reverse=True)
+    calls = [{'songIndexToRemove': to_remove[i:i + chunk_size]} for i in range(0, len(to_remove), chunk_size)]
+    calls += [{'songIdToAdd': to_add[i:i + chunk_size]} for i in range(0, len(to_add), chunk_size)]
+    calls = calls or [{}]
+    calls[0]['name'] = playlist_name
+    for call in calls:
+        # index removals are not idempotent: no blind retry, the caller rebuilds the playlist on failure
+        if not subsonic_get_json(url, dict(base_params, **call), tries=1, timeout=30, method='POST'):
+            log.warning("Playlist '%s' could not be updated in place.", playlist_name)
+            return False
+    log.info("Playlist '%s' updated in place: %s kept, %s removed, %s added (%s request(s))",
+             playlist_name, len(present), len(to_remove), len(to_add), len(calls))
+    return True
 
 def delete_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_id):
     url = SUBSONIC_URL + "/rest/deletePlaylist"
@@ -265,9 +570,9 @@ def delete_playlist(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, playlist_id):
     }
     data = subsonic_get_json(url, params)
     if not data:
-        print(f"Failed to delete playlist ID: {playlist_id}")
+        log.warning("Failed to delete playlist ID: %s", playlist_id)
         return None
-    print(f"Playlist ID {playlist_id} deleted.")
+    log.info("Playlist ID %s deleted.", playlist_id)
     return data
 
 def get_all_playlists(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
@@ -288,7 +593,7 @@ def get_all_playlists(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
         playlists = playlists_container.get("playlist", [])
         return playlists
     except Exception as e:
-        print(f"Error parsing playlists: {e}")
+        log.warning("Error parsing playlists: %s", e)
         return []
 
 def get_playlists_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
@@ -298,7 +603,7 @@ def get_playlists_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
     for playlist in playlists:
         playlist_name = playlist.get('name', '')
         if "Weekly Discovery" in playlist_name: 
-            print(f"[TEST] Playlist ignorée pour la protection : {playlist_name}")
+            log.debug("[TEST] Playlist ignorée pour la protection : %s", playlist_name)
             continue
         id = playlist.get('id')
         params = {
@@ -316,14 +621,12 @@ def get_playlists_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
             resp = data.get("subsonic-response", {})
             json_playlist = resp.get("playlist", {})
             entry = json_playlist.get('entry', [])
-            if not entry:
-                return []
             for ent in entry:
                 song_id = ent.get('id')
                 if song_id:
                     all_songs_ids.append(song_id)
         except Exception as e:
-            print(f"Error parsing playlists: {e}")
+            log.warning("Error parsing playlists: %s", e)
             continue
     all_songs_ids = list(dict.fromkeys(all_songs_ids))
     return all_songs_ids
@@ -351,78 +654,158 @@ def get_liked_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
             song_id = star.get('id')
             all_songs_ids.append(song_id)
     except Exception as e:
-        print(f"Error parsing starred songs: {e}")
+        log.warning("Error parsing starred songs: %s", e)
         return []
     all_songs_ids = list(dict.fromkeys(all_songs_ids))
     return all_songs_ids
 
-def flag_for_cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, old_playlist_datas):
-    """
-    Determines which files from the PREVIOUS weekly playlist should be deleted.
-    Protects files if they were liked (starred) or added to other playlists in the meantime.
-    """
-    playlist_or_starred = []
+def protected_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS):
+    """Ids of the songs starred or in a (non weekly) playlist. None when the lists could not be fully read."""
     in_playlist_songs = get_playlists_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
     liked_songs = get_liked_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
-    playlist_or_starred = set(in_playlist_songs) | set(liked_songs)
-    
-    # deduplication
-    playlist_or_starred = list(dict.fromkeys(playlist_or_starred))
+    if deadline.expired() or deadline.is_open('subsonic'):
+        # protection lists may be incomplete: never delete on partial data
+        log.warning("Cleanup skipped: playlists/starred songs could not be fully read in time.")
+        return None
+    return set(in_playlist_songs) | set(liked_songs)
 
-    external_downloaded_subsonic = old_playlist_datas.get("subsonic_downloaded", [])
-    external_downloaded_youtube = old_playlist_datas.get("youtube_downloaded", [])
-    external_downloaded = set(external_downloaded_subsonic) | set(external_downloaded_youtube)
+def flag_for_cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, candidate_ids):
+    """
+    Determines which files downloaded for the PREVIOUS weekly playlist should be deleted.
+    candidate_ids only contains songs downloaded by the script (already local tracks are never candidates).
+    Protects files if they were liked (starred) or added to other playlists in the meantime.
+    """
+    playlist_or_starred = protected_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
+    if playlist_or_starred is None:
+        return []
 
     # get list of all the ID that are starred or inside a playlist from the OLD weekly discovery
-    matches = list(set(playlist_or_starred) & set(external_downloaded))
-    already_local = old_playlist_datas.get("already_local", [])
-    already_local_ids = [track['download_id'] for track in already_local if 'download_id' in track]
+    matches = [track_id for track_id in candidate_ids if track_id in playlist_or_starred]
+    to_delete = [track_id for track_id in candidate_ids if track_id not in playlist_or_starred]
+
+    log.info("Starred or in playlist from weekly discovery: %s", len(matches))
+    log.debug("Starred or in playlist IDs: %s", matches)
+    log.info("Downloaded for the previous weekly discovery = %s", len(candidate_ids))
+    log.info("To delete: %s", len(to_delete))
+    log.debug("To delete IDs: %s", to_delete)
+    return to_delete
 
-    not_delete = set(already_local_ids) | set(matches)
+def get_song(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, song_id):
+    """Song details (path, size, played, playCount...) or None."""
+    params = {
+        'u': SUBSONIC_USER,
+        'p': SUBSONIC_PASS,
+        'v': '1.16.1',
+        'c': 'python-script',
+        'f': 'json',
+        'id': song_id
+    }
+    data = subsonic_get_json(SUBSONIC_URL + "/rest/getSong", params)
+    if not data:
+        return None
+    return data['subsonic-response'].get('song')
 
-    all_tracks_ids = old_playlist_datas.get("all_tracks_ids", [])
+def missing_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, song_ids, workers=4):
+    """
+    Song ids the server reports as gone (getSong: data not found), checked in parallel.
+    Ids that could not be checked (network error, deadline) are assumed to still exist.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-    to_delete = []
+    def is_missing(song_id):
+        params = {
+            'u': SUBSONIC_USER,
+            'p': SUBSONIC_PASS,
+            'v': '1.16.1',
+            'c': 'python-script',
+            'f': 'json',
+            'id': song_id
+        }
+        return subsonic_get_json(SUBSONIC_URL + "/rest/getSong", params, tries=2, not_found=False) is False
+
+    song_ids = list(dict.fromkeys(song_ids))
+    if not song_ids:
+        return set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="getsong") as pool:
+        gone = {song_id for song_id, missing in zip(song_ids, pool.map(is_missing, song_ids)) if missing}
+    log.info("Checked %s song(s) still in the library: %s gone.", len(song_ids), len(gone))
+    return gone
+
+def _last_played(song, downloaded_at):
+    """Last play as a timestamp (the download time when the song was never played)."""
+    played = song.get('played')
+    if played:
+        try:
+            return datetime.fromisoformat(played.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+    return downloaded_at
 
-    for track_id in all_tracks_ids:
-        if track_id not in not_delete:
-            to_delete.append(track_id)
-
-    print(f"Starred or in playlist from weekly discovery = {matches}")
-    print("-"*30)
-    print(f"Already local = {already_local}")
-    print("-"*30)
-    print(f"Full list of id from weekly discovery = {all_tracks_ids} with {len(all_tracks_ids)}")
-    print("-"*30)
-    print(f"To not delete : {not_delete}")
-    print(f"To delete : {to_delete}, with {len(to_delete)}")
+def flag_for_eviction(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, LOCAL_DOWNLOAD_PATH, downloads, keep_ids, max_bytes):
+    """
+    Treats every file downloaded by the script as a cache bounded to max_bytes.
+    downloads is {song_id: downloaded_at}. When the total size is over budget, the least recently played
+    songs (never played ones by download date, then lowest playCount) are returned for deletion until it fits.
+    Songs starred, in a playlist or in keep_ids (the new weekly playlist) are never evicted.
+    """
+    protected = protected_songs(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS)
+    if protected is None:
+        return []
+    protected |= set(keep_ids)
+
+    total = 0
+    evictable = []
+    for song_id, downloaded_at in downloads.items():
+        if deadline.expired():
+            log.warning("Eviction skipped: download sizes could not be read in time.")
+            return []
+        song = get_song(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, song_id)
+        if not song:
+            continue
+        size = song.get('size')
+        if not size and song.get('path'):
+            try:
+                size = os.path.getsize(os.path.join(LOCAL_DOWNLOAD_PATH, song['path']))
+            except OSError:
+                size = 0
+        size = size or 0
+        total += size
+        if song_id not in protected:
+            evictable.append((_last_played(song, downloaded_at), song.get('playCount', 0), song_id, size))
+
+    log.info("Discovery downloads: %.1f MB used for a budget of %.1f MB (%s files, %s evictable).",
+             total / 2**20, max_bytes / 2**20, len(downloads), len(evictable))
+    to_delete = []
+    for _, _, song_id, size in sorted(evictable):
+        if total <= max_bytes:
+            break
+        to_delete.append(song_id)
+        total -= size
+    log.info("To evict: %s", len(to_delete))
+    log.debug("To evict IDs: %s", to_delete)
     return to_delete
 
+def _remove(path):
+    """os.remove(), except in a replayed run (HTTP_REPLAY) that must leave the disk untouched."""
+    if replay.active():
+        log.info("[Replay] not deleted: %s", path)
+        return
+    os.remove(path)
+
 def cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, LOCAL_DOWNLOAD_PATH, to_delete):
     """
     Performs physical file deletion. Includes 'Surgical Cleaning' logic to find files 
     even if the filename doesn't perfectly match the Subsonic path.
+    Returns the list of song ids whose file was removed.
     """
-    url = SUBSONIC_URL + "/rest/getSong"
-    base_params = {
-        'u': SUBSONIC_USER,
-        'p': SUBSONIC_PASS,
-        'v': '1.16.1',
-        'c': 'python-script',
-        'f': 'json'
-    }
-    deleted_count = 0
-    print(f"Starting cleanup for {len(to_delete)} items...")
+    from thefuzz import fuzz
+    deleted_ids = []
+    log.info("Starting cleanup for %s items...", len(to_delete))
 
     for song_id in to_delete:
-        params = base_params.copy()
-        params['id'] = song_id
-        data = subsonic_get_json(url, params)
-        
-        if not data: continue
-        
-        resp = data.get("subsonic-response", {})
-        song = resp.get('song', {})
+        song = get_song(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, song_id)
+        if not song: continue
+
         relative_path = song.get('path')
         title = song.get('title')
         
@@ -434,9 +817,10 @@ def cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, LOCAL_DOWNLOAD_PATH, to
         
         # 2. Suppression Directe (Match parfait)
         if os.path.exists(full_path_theorique):
-            os.remove(full_path_theorique)
-            print(f"[Deleted] Direct match: {relative_path}")
-            deleted_count += 1
+            _remove(full_path_theorique)
+            log.info("[Deleted] Direct match: %s", relative_path)
+            deleted_ids.append(song_id)
+            forget_songs([song_id])
             continue
 
         # 3. Recherche de dossier (Album ou Artiste)
@@ -504,16 +888,17 @@ def cleaning(SUBSONIC_URL, SUBSONIC_USER, SUBSONIC_PASS, LOCAL_DOWNLOAD_PATH, to
                 if score >= 80:
                     real_file_path = os.path.join(folder, f)
                     
-                    os.remove(real_file_path)
-                    print(f"[Deleted] Fuzzy match: {f}")
-                    print(f"          (Cible: {title} | CleanFile: {clean_filename} | Score: {score})")
+                    _remove(real_file_path)
+                    log.info("[Deleted] Fuzzy match: %s", f)
+                    log.info("          (Cible: %s | CleanFile: %s | Score: %s)", title, clean_filename, score)
                     
-                    deleted_count += 1
+                    deleted_ids.append(song_id)
+                    forget_songs([song_id])
                     found_in_folder = True
                     break 
                 
                 # Debug seulement si score moyen pour comprendre
                 elif score > 60:
-                     print(f"   [Debug] Rejeté (Score {score}): '{clean_filename}' vs '{clean_target_title}'")
+                     log.debug("   [Debug] Rejeté (Score %s): '%s' vs '%s'", score, clean_filename, clean_target_title)
 
-    return deleted_count
+    return deleted_ids
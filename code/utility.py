@@ -1,6 +1,21 @@
-from thefuzz import fuzz
 import re
 
+# Maximum gap (seconds) between the expected duration of a track and a candidate's (0 disables the check)
+_duration_tolerance = 30
+
+def configure(duration_tolerance=30):
+    global _duration_tolerance
+    _duration_tolerance = duration_tolerance
+
+def duration_mismatch(expected, actual):
+    """
+    True when both durations (seconds) are known and too far apart: a live set, a teaser or another version.
+    Cheap check done before any fuzzy matching or download.
+    """
+    if not _duration_tolerance or not expected or not actual:
+        return False
+    return abs(float(expected) - float(actual)) > _duration_tolerance
+
 def normalize_text(text):
     """
     Normalizes text by converting to lowercase, replacing special characters,
@@ -78,6 +93,8 @@ def similarity(expected_artist, expected_title, found_artist, found_title):
     Calculates a similarity score (0.0 to 1.0) between expected and found metadata.
     Includes specific protections for short names to avoid false positives.
     """
+    from thefuzz import fuzz # lazy: only paid when a comparison actually happens
+
     ea = normalize_text(expected_artist)
     et = normalize_text(expected_title)
     fa = normalize_text(found_artist)
@@ -0,0 +1,195 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import daemon
+import logging
+
+log = logging.getLogger(__name__)
+
+# Detects when downloaded files have really landed in LOCAL_DOWNLOAD_PATH before asking for a scan.
+# Uses inotify (Linux) when available, otherwise compares snapshots of the folder every few seconds.
+
+AUDIO_EXTENSIONS = ('.mp3', '.flac', '.m4a', '.wav', '.opus', '.ogg')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+def is_audio(path):
+    return path.lower().endswith(AUDIO_EXTENSIONS)
+
+def snapshot(root):
+    """Returns {path: size} for every audio file under root."""
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not is_audio(name):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                files[path] = os.stat(path).st_size
+            except OSError:
+                continue
+    return files
+
+class _Inotify:
+    """Minimal recursive inotify wrapper (ctypes, no extra dependency)."""
+    def __init__(self, root):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {} # wd -> directory
+        try:
+            for dirpath, _, _ in os.walk(root):
+                self.add_dir(dirpath)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_dir(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            # ENOSPC (too many watches) and co: caller falls back to polling
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self._dirs[wd] = path
+
+    def read(self, timeout):
+        """Waits up to timeout seconds, returns a list of (path, is_dir) touched. None means overflow."""
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        changes = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            changes.append((os.path.join(directory, os.fsdecode(name)), bool(mask & IN_ISDIR)))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DownloadWatcher:
+    """
+    Start it BEFORE triggering downloads, then call wait() once they are triggered.
+    wait() returns the new audio files that appeared and stopped growing.
+    """
+    def __init__(self, root, poll_interval=5):
+        self.root = root
+        self.poll_interval = poll_interval
+        self._inotify = None
+        start = time.monotonic()
+        self._before = snapshot(root)
+        self._walk_time = time.monotonic() - start # duration of the last full snapshot (polling mode)
+        self._seen = {} # path -> (size, time of last size change)
+        try:
+            self._inotify = _Inotify(root)
+        except (OSError, AttributeError) as e:
+            log.info("inotify unavailable (%s), polling %s every %ss instead.", e, root, poll_interval)
+            if self._inotify:
+                self._inotify.close()
+            self._inotify = None
+
+    def _touch(self, path):
+        if not is_audio(path):
+            return
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            self._seen.pop(path, None)
+            return
+        if self._before.get(path) == size and path not in self._seen:
+            return
+        previous = self._seen.get(path)
+        if previous is None or previous[0] != size:
+            self._seen[path] = (size, time.monotonic())
+
+    def _rescan(self):
+        start = time.monotonic()
+        files = snapshot(self.root)
+        self._walk_time = time.monotonic() - start
+        for path, size in files.items():
+            if self._before.get(path) != size or path in self._seen:
+                self._touch(path)
+
+    def _collect(self, timeout):
+        if self._inotify is None:
+            daemon.sleep(timeout)
+            self._rescan()
+            return
+        changes = self._inotify.read(timeout)
+        if changes is None:
+            self._rescan()
+            return
+        for path, is_dir in changes:
+            if is_dir:
+                # new artist/album folder: watch it (and the sub-folders already created inside,
+                # makedirs is faster than us) and pick up files already written inside
+                try:
+                    for dirpath, _, _ in os.walk(path):
+                        self._inotify.add_dir(dirpath)
+                except OSError:
+                    pass
+                for sub_path in snapshot(path):
+                    self._touch(sub_path)
+            else:
+                self._touch(path)
+
+    def wait(self, expected, timeout=600, settle=10):
+        """
+        Blocks until `expected` new files are there and none grew during `settle` seconds,
+        or until timeout. Returns the list of new files that are complete (possibly empty).
+        """
+        start = time.monotonic()
+        while True:
+            now = time.monotonic()
+            # re-stat what we saw: sizes keep changing while a download is running
+            for path in list(self._seen):
+                self._touch(path)
+            stable = [p for p, (_, changed) in self._seen.items() if now - changed >= settle]
+            if self._seen and len(stable) == len(self._seen) and len(stable) >= expected:
+                break
+            left = timeout - (now - start)
+            if daemon.stop_requested():
+                log.info("Download wait interrupted: %s new file(s) seen.", len(self._seen))
+                break
+            if left <= 0:
+                log.info("Download wait timeout: %s new file(s), %s complete, %s expected.", len(self._seen), len(stable), expected)
+                break
+            self._collect(min(left, self._poll_delay()))
+        now = time.monotonic()
+        return sorted(p for p, (_, changed) in self._seen.items() if now - changed >= settle)
+
+    def _poll_delay(self):
+        if self._inotify is not None:
+            return 1.0
+        # polling walks and stats the whole folder: on a big library keep it under ~10% of the time
+        return max(self.poll_interval, 10 * self._walk_time)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
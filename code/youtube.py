@@ -1,7 +1,15 @@
-import yt_dlp
 import utility
+import ratelimit
+import deadline
+import replay
+import time
+import glob
 import re
 import os
+import logging
+from models import Candidate
+
+log = logging.getLogger(__name__)
 
 def parse_youtube_video(video_entry, target_artist, target_title):
     """
@@ -55,9 +63,10 @@ def parse_youtube_video(video_entry, target_artist, target_title):
 
     return best_score, detected_infos
 
-def search_yt(artist, title, limit=5):
-    """Searches YouTube with multiple query variations to find the best audio match."""
-    print(f"Searching YT for: {artist} - {title}")
+def search_yt(track, limit=5):
+    """Searches YouTube with multiple query variations to find the best audio match for a Track."""
+    artist, title = track.artist, track.title
+    log.info("Searching YT for: %s - %s", artist, title)
 
     cleaned_artist = utility.clean_artist_name(artist)
 
@@ -75,57 +84,104 @@ def search_yt(artist, title, limit=5):
         'extract_flat': True,
         'ignoreerrors': True,
         'noplaylist': True,
-        'search_sort': 'relevance'
+        'search_sort': 'relevance',
+        'socket_timeout': deadline.clamp(30),
     }
 
     best_match = None
     highest_score = 0.0
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    # yt-dlp (heavy import, only paid when a YouTube fallback is really needed) or its HTTP_RECORD / HTTP_REPLAY stand-in
+    with replay.youtube_dl(ydl_opts) as ydl:
         for query in search_queries:
+            if not deadline.can_call('youtube'):
+                break
             try:
                 search_query = f"ytsearch{limit}:{query}"
+                ratelimit.acquire('youtube')
                 result = ydl.extract_info(search_query, download=False)
+                if not result:
+                    # errors are ignored by yt-dlp (throttling, network): slow down and try the next query
+                    ratelimit.feedback('youtube', error=True)
+                    continue
                 if result['entries']:
                     for entry in result['entries']:
                         if not entry:
                             continue
+                        # flat results carry the duration: drop live sets and teasers before scoring
+                        if utility.duration_mismatch(track.duration, entry.get('duration')):
+                            log.debug("Skipped: %s | %ss instead of %ss", entry.get('title'), entry.get('duration'), track.duration)
+                            continue
                         score, info = parse_youtube_video(entry, artist, title)
-                        print(f"Analyzed: {entry.get('title')} | Score: {score:.2f}")
-                        video_id = entry.get('id')
+                        log.debug("Analyzed: %s | Score: %.2f", entry.get('title'), score)
                         if score > highest_score and score >= 0.70 and info:
                             highest_score = score
-                            best_match = {
-                                'id': video_id,
-                                'title': info['title'],
-                                'artist': info['artist'],
-                                'target_artist': artist, 
-                                'target_title': title, 
-                                'original_title': entry.get('title'),
-                                'url': f"https://www.youtube.com/watch?v={video_id}",
-                                'score': score                                
-                            }
+                            best_match = Candidate(entry.get('id'), info['artist'], info['title'], score,
+                                                   source='youtube', track=track, original_title=entry.get('title'))
 
             except Exception as e:
-                import traceback
-                traceback.print_exc()
-                print(f"YT Search Error: {e}")    
+                log.warning("YT Search Error: %s", e, exc_info=True)
                 return None            
     if best_match:
-        print(f"-> Selected: {best_match['original_title']} (Score: {best_match['score']:.2f})")
+        log.info("-> Selected: %s (Score: %.2f)", best_match.original_title, best_match.similarity)
     else:
         best_match = None
-        print("-> No valid match found on YouTube.")
+        log.info("-> No valid match found on YouTube.")
     return best_match
 
-def download_yt(match_info, BASE_FOLDER):
-    """Downloads the selected YouTube video as an MP3 with embedded metadata."""
-    if not match_info or not match_info['url']:
-        print("No valid information.")
+class SpeculativeSearch:
+    """
+    Runs search_yt() in background threads for tracks that may end up in the YouTube fallback
+    (external tracks whose Octo-Fiesta download is still pending). Only searches, never downloads.
+    """
+    def __init__(self, workers=2, limit=10):
+        from concurrent.futures import ThreadPoolExecutor
+        self.limit = limit
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="yt-search")
+        self._futures = {} # track key -> Future
+
+    def submit(self, track):
+        if track.key not in self._futures:
+            self._futures[track.key] = self._executor.submit(search_yt, track, self.limit)
+
+    def discard(self, track):
+        """The track was found another way: drop its search (cancelled if not started yet)."""
+        future = self._futures.pop(track.key, None)
+        if future is not None:
+            future.cancel()
+
+    def result(self, track):
+        """The match of the speculative search (waits for it if still running), or a normal search."""
+        future = self._futures.pop(track.key, None)
+        if future is None or future.cancelled():
+            return search_yt(track, self.limit)
+        try:
+            return future.result()
+        except Exception as e:
+            log.warning("Speculative YT search failed for %s - %s: %s", track.artist, track.title, e)
+            return search_yt(track, self.limit)
+
+    def close(self):
+        self._futures.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def download_yt(match_info, BASE_FOLDER, timeout=None):
+    """
+    Downloads the selected YouTube video as an MP3 with embedded metadata.
+    The download is cancelled (and partial files removed) after `timeout` seconds or when the run/step budget is over.
+    """
+    if not match_info or not match_info.url:
+        log.info("No valid information.")
         return False
-    
-    folder_artist = match_info.get('target_artist', match_info['artist'])
-    file_title = match_info.get('target_title', match_info['title'])
+    if replay.active():
+        # replayed run: the recorded outcome, no folder or file is created
+        return replay.download_outcome(match_info.url)
+    import yt_dlp
+
+    # files are named after the ListenBrainz track so the rescan finds them under the expected name
+    target = match_info.track or match_info
+    folder_artist = target.artist
+    file_title = target.title
 
     artist_clean = utility.sanitize_filename(folder_artist) 
     title_clean = utility.sanitize_filename(file_title)
@@ -135,9 +191,19 @@ def download_yt(match_info, BASE_FOLDER):
     # Création des dossiers si inexistants
     if not os.path.exists(output_path):
         os.makedirs(output_path)
-        print(f"Dossier créé : {output_path}")
+        log.info("Dossier créé : %s", output_path)
     filename_template = os.path.join(output_path, f"{title_clean}.%(ext)s")
-    print(f"Lancement du téléchargement pour : {artist_clean} - {title_clean}")
+    log.info("Lancement du téléchargement pour : %s - %s", artist_clean, title_clean)
+
+    if not deadline.can_call('youtube'):
+        return False
+    limits = [t for t in (timeout, deadline.remaining()) if t is not None]
+    track_deadline = time.monotonic() + min(limits) if limits else None
+
+    def check_deadline(d):
+        # called by yt-dlp on every progress update and before each post-processing step
+        if track_deadline is not None and time.monotonic() > track_deadline:
+            raise yt_dlp.utils.DownloadCancelled(f"download time limit reached for {title_clean}")
 
     ydl_opts = {
         'format': 'bestaudio/best',             # Meilleure qualité audio
@@ -150,16 +216,33 @@ def download_yt(match_info, BASE_FOLDER):
         'quiet': False,
         'no_warnings': True,
         'addmetadata': True,
+        'socket_timeout': deadline.clamp(30),
+        'progress_hooks': [check_deadline],
+        'postprocessor_hooks': [check_deadline],
         'postprocessor_args': [
             '-metadata', f'artist={folder_artist}',
             '-metadata', f'title={file_title}'      
         ],
     }
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([match_info['url']])
-        print(f"Téléchargement terminé avec succès dans : {output_path}")
+        ratelimit.acquire('youtube')
+        with replay.youtube_dl(ydl_opts) as ydl:
+            ydl.download([match_info.url])
+        log.info("Téléchargement terminé avec succès dans : %s", output_path)
+        deadline.record_success('youtube')
         return True
+    except yt_dlp.utils.DownloadCancelled as e:
+        log.warning("Téléchargement annulé : %s", e)
+        # remove what was left behind (.part, .ytdl, not yet converted files), never a finished mp3
+        for leftover in glob.glob(os.path.join(glob.escape(output_path), glob.escape(title_clean) + ".*")):
+            if leftover.endswith('.mp3'):
+                continue
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+        return False
     except Exception as e:
-        print(f"Erreur lors du téléchargement : {e}")
+        deadline.record_failure('youtube')
+        log.warning("Erreur lors du téléchargement : %s", e)
         return False